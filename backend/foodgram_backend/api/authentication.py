@@ -0,0 +1,88 @@
+import copy
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from rest_framework.authentication import TokenAuthentication
+
+from api.cache import get_stamp
+
+AUTH_NAMESPACE = "auth"
+TOKEN_CACHE_TIMEOUT = 60
+TOKEN_CACHE_SIZE = 10_000
+
+
+class TokenCache:
+    """ LRU-кэш токенов в памяти процесса с ограниченным временем жизни.
+
+        Записи помнят версию AUTH_NAMESPACE, при которой были прочитаны.
+        Когда версия в общем кэше меняется (выход, смена пароля,
+        блокировка), кэш процесса очищается целиком. Если общий кэш
+        у процессов свой (LocMem), устаревшая запись живет не дольше
+        TOKEN_CACHE_TIMEOUT секунд.
+    """
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, timeout=TOKEN_CACHE_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, token, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user, token
+
+    def set(self, key, user, token, version):
+        with self.lock:
+            # Пока читали токен из базы, его могли успеть отозвать.
+            if version != self.version:
+                return
+            self.entries[key] = (user, token,
+                                 time.monotonic() + self.timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ TokenAuthentication, который не ходит в базу за каждым запросом.
+
+        Пользователь и токен берутся из token_cache, в базу идет только
+        промах. Каждый запрос получает свои копии объектов, чтобы
+        изменения request.user не попадали в кэш.
+    """
+
+    def authenticate_credentials(self, key):
+        # Сравнивается вся отметка: после сброса общего кэша номер
+        # версии начинается заново, а время - уже нет.
+        version = get_stamp(AUTH_NAMESPACE)
+        cached = token_cache.get(key, version)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user, token, version)
+            cached = user, token
+        user, token = cached
+        user = copy.copy(user)
+        token = copy.copy(token)
+        token.user = user
+        return user, token
@@ -0,0 +1,141 @@
+import time
+from hashlib import md5
+
+from django.core.cache import cache, caches
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK
+
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+TAGS_NAMESPACE = "tags"
+RECIPES_NAMESPACE = "recipes"
+PAGE_CACHE_ALIAS = "pages"
+PAGE_CACHE_TIMEOUT = 5 * 60
+
+
+def get_stamp(namespace):
+    """ Версия данных и время их последнего изменения.
+
+        Хранится в общем кэше, поэтому все процессы видят одну версию.
+        Начальная версия берется от времени: после сброса кэша она
+        не совпадет ни с одной из прежних.
+    """
+    key = f"{namespace}:stamp"
+    stamp = cache.get(key)
+    if stamp is None:
+        cache.add(key, (time.time_ns(), int(time.time())), None)
+        stamp = cache.get(key)
+    return stamp
+
+
+def bump_stamp(namespace):
+    version, _ = get_stamp(namespace)
+    cache.set(f"{namespace}:stamp", (version + 1, int(time.time())), None)
+
+
+class CachedResponseMixin:
+    """ Кэш ответов list/retrieve для почти неизменных справочников.
+
+        Ключ зависит от версии данных, поэтому после изменения модели
+        старые ответы просто перестают читаться. Отдает ETag и
+        Last-Modified и отвечает 304, если у клиента актуальная копия.
+    """
+    cache_namespace = None
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request,
+                                    *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        version, modified = get_stamp(self.cache_namespace)
+        query = "&".join(sorted(request.GET.urlencode().split("&")))
+        fingerprint = md5(
+            f"{version}:{request.accepted_renderer.format}:"
+            f"{request.path}?{query}".encode()
+        ).hexdigest()
+        etag = f'"{fingerprint}"'
+
+        validators = {
+            "ETag": etag,
+            "Last-Modified": http_date(modified),
+            "Cache-Control": "public, no-cache",
+        }
+        not_modified = get_conditional_response(request, etag=etag,
+                                                last_modified=modified)
+        if not_modified is not None:
+            # 304 повторяет валидаторы (RFC 7232, 4.1)
+            for header, value in validators.items():
+                not_modified[header] = value
+            return not_modified
+
+        key = f"{self.cache_namespace}:response:{fingerprint}"
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != HTTP_200_OK:
+                return response
+            cache.set(key, response.data, RESPONSE_CACHE_TIMEOUT)
+        else:
+            response = Response(data)
+
+        for header, value in validators.items():
+            response[header] = value
+        return response
+
+
+class CachedPageMixin:
+    """ Общий кэш готовых страниц списка.
+
+        Кэшируются только запросы с параметрами из page_cache_params,
+        ключ строится по их нормализованным значениям, хосту и формату
+        и не зависит от пользователя. Попадание в кэш не трогает ORM:
+        пользовательские поля накладываются поверх готовой страницы
+        в overlay_cached_page(). Бэкенд задается алиасом
+        PAGE_CACHE_ALIAS в CACHES (память, файлы или база).
+    """
+    cache_namespace = None
+    page_cache_params = ()
+    multi_value_params = ()
+
+    def list(self, request, *args, **kwargs):
+        key = self.get_page_cache_key(request)
+        if key is None:
+            return super().list(request, *args, **kwargs)
+
+        page_cache = caches[PAGE_CACHE_ALIAS]
+        data = page_cache.get(key)
+        if data is None:
+            response = super().list(request, *args, **kwargs)
+            if response.status_code == HTTP_200_OK:
+                page_cache.set(key, response.data, PAGE_CACHE_TIMEOUT)
+            return response
+        self.overlay_cached_page(data)
+        return Response(data)
+
+    def get_page_cache_key(self, request):
+        params = request.query_params
+        allowed = set(self.page_cache_params) | {
+            self.settings.URL_FORMAT_OVERRIDE
+        }
+        if not set(params) <= allowed:
+            return None
+        normalized = []
+        for name in self.page_cache_params:
+            if name in self.multi_value_params:
+                values = sorted(set(params.getlist(name)))
+            else:
+                values = [params.get(name, "")]
+            normalized.append(f"{name}={','.join(values)}")
+        version, _ = get_stamp(self.cache_namespace)
+        fingerprint = md5(
+            f"{request.accepted_renderer.format}:{request.get_host()}:"
+            f"{request.path}?{'&'.join(normalized)}".encode()
+        ).hexdigest()
+        return f"{self.cache_namespace}:page:{version}:{fingerprint}"
+
+    def overlay_cached_page(self, data):
+        pass
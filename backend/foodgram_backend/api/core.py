@@ -1,3 +1,10 @@
+from django.db import connections, router
+from django.db.models import F
+from django.db.models.constants import OnConflict
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save
+from django.db.models.sql import InsertQuery
+
 # recipes
 MIN_TIME_COOK = 1
 MAX_TIME_COOK = 500
@@ -5,29 +12,56 @@ MIN_COUNT_INGR = 1
 MAX_COUNT_INGR = 32000
 DEFAULT_INGR = 1
 MAX_SIZE_IMAGE = (1000, 1000)
+IMAGE_VARIANTS = {
+    "thumbnail": (320, 320),
+    "medium": (640, 640),
+}
+# Загрузка картинок: лимиты проверяются до полного раскодирования
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_IMAGE_PIXELS = 25_000_000
+BASE64_CHUNK_SIZE = 64 * 1024
+# Картинка в processing дольше этого (в секундах) считается брошенной:
+# воркер умер, и process_images возвращает ее в очередь
+IMAGE_CLAIM_TIMEOUT = 10 * 60
+IMAGE_FORMATS = {
+    "jpeg": "jpg",
+    "png": "png",
+    "gif": "gif",
+    "webp": "webp",
+}
 MAX_LENGTH_NAME_TAG = 56
 MAX_LENGTH_NAME_INGR = 56
 MAX_LENGTH_NAME_RECIPE = 56
 MAX_LENGTH_NAME_COLOR = 56
 MAX_LENGTH_MEASUR_UNIT = 56
 
+# пакетные операции с избранным и корзиной
+MAX_BATCH_RECIPES = 100
+
+# рейтинги рецептов (manage.py compute_rankings)
+RANKING_SIZE = 1000
+TRENDING_WINDOW_DAYS = 7
+
+# ingredients search
+INGREDIENT_SEARCH_LIMIT = 50
+INGREDIENT_SEARCH_MAX_LIMIT = 500
+
 
 def id_and_amount_pull_out_from_dict(classes, data_ingr):
-    """ Вытаскивает id и amount из
-        request.context['ingredients'] в виде кортежа
+    """ Сопоставляет пары (id, amount) с объектами одним запросом
+        .in_bulk(): количество привязано к id, а не к позиции в выдаче.
+        Повторы одного id складываются.
+        Возвращает список (объект, amount) и список ненайденных id.
     """
-    id_list = []
-    amounts = []
+    amounts = {}
+    for pk, amount in data_ingr:
+        amounts[pk] = amounts.get(pk, 0) + amount
 
-    for ingredient in data_ingr:
-        for name, value in ingredient.items():
-            if name == "id":
-                id_list.append(value)
-            elif name == "amount":
-                amounts.append(value)
-
-    ingredients = classes.objects.filter(id__in=id_list)
-    return list(zip(ingredients, amounts))
+    ingredients = classes.objects.in_bulk(amounts)
+    missing = [pk for pk in amounts if pk not in ingredients]
+    found = [(ingredients[pk], amount) for pk, amount in amounts.items()
+             if pk in ingredients]
+    return found, missing
 
 
 def make_new_count_ingr(classes, recipe, ingredients):
@@ -41,3 +75,137 @@ def make_new_count_ingr(classes, recipe, ingredients):
                               recipe=recipe)
         amount_list.append(amount_ingr)
     classes.objects.bulk_create(amount_list)
+
+
+def update_count_ingr(classes, recipe, ingredients):
+    """ Приводит ингредиенты рецепта к списку ingredients, трогая только
+        то, что изменилось: новые пары добавляет, у оставшихся
+        обновляет количество через .bulk_update(), убранные удаляет.
+    """
+    existing = {}
+    removed = []
+    for amount_ingr in recipe.amount.all():
+        if amount_ingr.ingredient_id in existing:
+            removed.append(amount_ingr.pk)
+        else:
+            existing[amount_ingr.ingredient_id] = amount_ingr
+
+    to_create = []
+    to_update = []
+    for ingredient, amount in ingredients:
+        amount_ingr = existing.pop(ingredient.id, None)
+        if amount_ingr is None:
+            to_create.append(classes(ingredient=ingredient,
+                                     amount=amount,
+                                     recipe=recipe))
+        elif amount_ingr.amount != int(amount):
+            amount_ingr.amount = amount
+            to_update.append(amount_ingr)
+    removed += [amount_ingr.pk for amount_ingr in existing.values()]
+
+    if removed:
+        classes.objects.filter(pk__in=removed).delete()
+    if to_update:
+        classes.objects.bulk_update(to_update, ("amount",))
+    if to_create:
+        classes.objects.bulk_create(to_create)
+
+
+def insert_ignore_sql(classes, objs):
+    """ SQL одного INSERT ... ON CONFLICT DO NOTHING для objs """
+    opts = classes._meta
+    db = router.db_for_write(classes)
+    query = InsertQuery(classes, on_conflict=OnConflict.IGNORE)
+    query.insert_values(
+        [field for field in opts.concrete_fields if field is not opts.pk],
+        objs,
+    )
+    sql, params = query.get_compiler(using=db).as_sql()[0]
+    return connections[db], sql, params
+
+
+def send_created(classes, obj, using):
+    """ post_save(created=True), как после save(): на нем держатся
+        счетчики в api/signals.py
+    """
+    post_save.send(sender=classes, instance=obj, created=True,
+                   update_fields=None, raw=False, using=using)
+
+
+def insert_or_ignore(classes, **fields):
+    """ Добавляет строку одним запросом INSERT ... ON CONFLICT DO NOTHING.
+        Возвращает созданный объект или None, если такая строка уже есть
+        (нарушился бы уникальный индекс). Для новой строки
+        отправляется post_save.
+    """
+    obj = classes(**fields)
+    opts = classes._meta
+    connection, sql, params = insert_ignore_sql(classes, [obj])
+    with connection.cursor() as cursor:
+        if connection.features.can_return_columns_from_insert:
+            column = connection.ops.quote_name(opts.pk.column)
+            cursor.execute(f"{sql} RETURNING {column}", params)
+            row = cursor.fetchone()
+            obj.pk = row[0] if row else None
+        else:
+            cursor.execute(sql, params)
+            obj.pk = cursor.lastrowid if cursor.rowcount else None
+    if obj.pk is None:
+        return None
+    obj._state.adding = False
+    obj._state.db = connection.alias
+    send_created(classes, obj, connection.alias)
+    return obj
+
+
+def bulk_insert_or_ignore(classes, objs, returning):
+    """ Один INSERT ... ON CONFLICT DO NOTHING на все objs.
+        Возвращает множество значений поля returning у строк, которые
+        действительно вставились, или None, если база не умеет
+        RETURNING - тогда это остается неизвестным, и post_save
+        отправляется для всех objs.
+    """
+    if not objs:
+        return set()
+    field = classes._meta.get_field(returning)
+    connection, sql, params = insert_ignore_sql(classes, objs)
+    with connection.cursor() as cursor:
+        if connection.features.can_return_columns_from_insert:
+            column = connection.ops.quote_name(field.column)
+            cursor.execute(f"{sql} RETURNING {column}", params)
+            inserted = {row[0] for row in cursor.fetchall()}
+        else:
+            cursor.execute(sql, params)
+            inserted = None
+    for obj in objs:
+        if inserted is None or getattr(obj, field.attname) in inserted:
+            send_created(classes, obj, connection.alias)
+    return inserted
+
+
+def change_counter(classes, field, delta, **lookup):
+    """ Меняет денормализованный счетчик одним UPDATE ... SET
+        field = field + delta, без чтения строки в память.
+        Вызывается в той же транзакции, что и сама запись.
+    """
+    if not delta:
+        return
+    value = F(field) + delta
+    if delta < 0:
+        value = Greatest(value, 0)
+    classes.objects.filter(**lookup).update(**{field: value})
+
+
+def exclude_counter_fields(instance, counter_fields, update_fields):
+    """ Обычный save() не пишет счетчики: в памяти может лежать
+        устаревшее значение, а меняются они только через F().
+    """
+    if instance._state.adding:
+        return update_fields
+    if update_fields is None:
+        deferred = instance.get_deferred_fields()
+        update_fields = [field.name
+                         for field in instance._meta.concrete_fields
+                         if not field.primary_key
+                         and field.attname not in deferred]
+    return [name for name in update_fields if name not in counter_fields]
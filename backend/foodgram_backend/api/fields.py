@@ -0,0 +1,100 @@
+import binascii
+import uuid
+from base64 import b64decode
+from hashlib import sha256
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from PIL import Image, UnidentifiedImageError
+from rest_framework.fields import ImageField
+from rest_framework.serializers import ValidationError
+
+from api.core import (BASE64_CHUNK_SIZE, IMAGE_FORMATS, MAX_IMAGE_BYTES,
+                      MAX_IMAGE_PIXELS)
+
+
+class StreamingBase64ImageField(ImageField):
+    """ Картинка строкой base64 или файлом из multipart-формы.
+
+        base64 раскодируется кусками во временный файл, поэтому в памяти
+        не собирается вторая копия картинки. Размер в байтах проверяется
+        до раскодирования, размер в пикселях - по заголовку картинки,
+        до чтения самих пикселей. Временный файл при сохранении модели
+        переносится в MEDIA_ROOT без копирования. В sha256 файла
+        записывается хэш загруженных байтов.
+    """
+    default_error_messages = {
+        "invalid_base64": "Картинка должна быть строкой base64 или файлом.",
+        "invalid_image": "Загрузите корректную картинку.",
+        "invalid_format": "Поддерживаются форматы: {formats}.",
+        "too_large": "Картинка не должна превышать {max_bytes} байт.",
+        "too_many_pixels": "Картинка не должна превышать "
+                           "{max_pixels} пикселей.",
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = self.decode(data)
+        elif not hasattr(data, "size"):
+            self.fail("invalid_base64")
+        try:
+            self.check_image(data)
+            return super().to_internal_value(data)
+        except ValidationError:
+            data.close()
+            raise
+
+    def decode(self, data):
+        content_type = None
+        if ";base64," in data:
+            header, data = data.split(";base64,", 1)
+            content_type = header.replace("data:", "")
+
+        decoded_size = len(data) * 3 // 4 - data[-2:].count("=")
+        if decoded_size > MAX_IMAGE_BYTES:
+            self.fail("too_large", max_bytes=MAX_IMAGE_BYTES)
+
+        upload = TemporaryUploadedFile(
+            name="base64", content_type=content_type,
+            size=decoded_size, charset=None,
+        )
+        digest = sha256()
+        try:
+            for start in range(0, len(data), BASE64_CHUNK_SIZE):
+                chunk = b64decode(data[start:start + BASE64_CHUNK_SIZE],
+                                  validate=True)
+                digest.update(chunk)
+                upload.write(chunk)
+        except (binascii.Error, ValueError):
+            upload.close()
+            self.fail("invalid_base64")
+        upload.size = upload.tell()
+        upload.sha256 = digest.hexdigest()
+        upload.seek(0)
+        return upload
+
+    def check_image(self, upload):
+        if upload.size > MAX_IMAGE_BYTES:
+            self.fail("too_large", max_bytes=MAX_IMAGE_BYTES)
+        try:
+            # Image.open читает только заголовок, пиксели не трогает.
+            with Image.open(upload) as image:
+                width, height = image.size
+                image_format = (image.format or "").lower()
+        except (UnidentifiedImageError, Image.DecompressionBombError,
+                OSError):
+            self.fail("invalid_image")
+        finally:
+            upload.seek(0)
+
+        if width * height > MAX_IMAGE_PIXELS:
+            self.fail("too_many_pixels", max_pixels=MAX_IMAGE_PIXELS)
+        if image_format not in IMAGE_FORMATS:
+            self.fail("invalid_format", formats=", ".join(IMAGE_FORMATS))
+        # Имя и расширение берем не от клиента, а по формату картинки.
+        upload.name = f"{uuid.uuid4()}.{IMAGE_FORMATS[image_format]}"
+        if not hasattr(upload, "sha256"):
+            digest = sha256()
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            upload.sha256 = digest.hexdigest()
+            upload.seek(0)
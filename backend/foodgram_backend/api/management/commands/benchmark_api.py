@@ -0,0 +1,516 @@
+import base64
+import csv
+import io
+import itertools
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from django.urls import URLResolver, reverse
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api import urls as api_urls
+from api.authentication import token_cache
+from api.cache import PAGE_CACHE_ALIAS
+from recipes.models import (Cart, CountIngredient, Favorite, Ingredient,
+                            Recipe, Tag)
+from users.models import CustomUser, Subscribe
+
+PASSWORD = "benchmark-password-42"
+SMALL_PAGE = 2
+LARGE_PAGE = 20
+SMALL_CART = 2
+SMALL_FOLLOWING = 2
+BATCH_SIZE = 20
+# Отдельный кэш, чтобы не трогать общий кэш приложения
+BENCHMARK_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "benchmark",
+    },
+    PAGE_CACHE_ALIAS: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "benchmark-pages",
+    },
+}
+
+# locmem из тестового окружения копирует письмо вместе с request
+# из контекста шаблона, а его скопировать нельзя
+BENCHMARK_EMAIL_BACKEND = "django.core.mail.backends.dummy.EmailBackend"
+
+
+def default_ingredients_file():
+    data_file = settings.BASE_DIR.parent.parent / "data" / "ingredients.csv"
+    if data_file.exists():
+        return data_file
+    return settings.BASE_DIR / "ingredients.csv"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def route_names(patterns):
+    """ Имена всех маршрутов из api/urls.py, включая вложенные include """
+    names = set()
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            names |= route_names(pattern.url_patterns)
+        elif pattern.name:
+            names.add(pattern.name)
+    return names
+
+
+class Command(BaseCommand):
+    help = ("Заполняет тестовую базу синтетическими данными, проходит по "
+            "всем маршрутам API и печатает число запросов к БД, "
+            "p50/p95 задержки и пиковую память. Падает, если число "
+            "запросов растет вместе с размером страницы или корзины.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--recipes", type=int, default=500)
+        parser.add_argument("--tags", type=int, default=10)
+        parser.add_argument("--ingredients", type=int, default=2000,
+                            help="Сколько строк взять из файла ингредиентов")
+        parser.add_argument("--ingredients-file", type=str,
+                            default=str(default_ingredients_file()))
+        parser.add_argument("--ingredients-per-recipe", type=int, default=8)
+        parser.add_argument("--favorites", type=int, default=20,
+                            help="Избранных рецептов на пользователя")
+        parser.add_argument("--carts", type=int, default=30,
+                            help="Рецептов в большой корзине")
+        parser.add_argument("--subscriptions", type=int, default=20,
+                            help="Подписок на пользователя")
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options["seed"])
+        self.counter = itertools.count()
+        media_root = tempfile.mkdtemp(prefix="foodgram-benchmark-")
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            with override_settings(MEDIA_ROOT=media_root,
+                                   IMAGE_PROCESSING_BROKER="database",
+                                   CACHES=BENCHMARK_CACHES,
+                                   EMAIL_BACKEND=BENCHMARK_EMAIL_BACKEND):
+                self.seed()
+                results = self.measure()
+                self.report(results)
+                self.check_errors(results)
+                self.check_coverage(results)
+                self.check_scaling()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    # Наполнение базы
+
+    def seed(self):
+        options = self.options
+        self.image_payload = self.make_image()
+
+        with open(options["ingredients_file"], encoding="utf-8") as f:
+            rows = itertools.islice(csv.reader(f), options["ingredients"])
+            Ingredient.objects.bulk_create(
+                [Ingredient(name=name, measurement_unit=unit)
+                 for name, unit in rows],
+                ignore_conflicts=True,
+            )
+        self.ingredients = list(Ingredient.objects.values_list("id",
+                                                               flat=True))
+
+        Tag.objects.bulk_create(
+            Tag(name=f"Тэг {i}", color=f"#{i:06X}", slug=f"tag-{i}")
+            for i in range(options["tags"])
+        )
+        self.tags = list(Tag.objects.all())
+
+        password = make_password(PASSWORD)
+        CustomUser.objects.bulk_create(
+            CustomUser(username=f"user{i}", email=f"user{i}@example.com",
+                       first_name=f"Имя{i}", last_name=f"Фамилия{i}",
+                       password=password)
+            for i in range(options["users"] + 3)
+        )
+        users = list(CustomUser.objects.order_by("id"))
+        self.user, self.small_user, self.spare_user = users[:3]
+        self.authors = users[3:]
+
+        Recipe.objects.bulk_create(
+            Recipe(author=self.random.choice(self.authors),
+                   name=f"Рецепт {i}", text="Текст рецепта " * 20,
+                   image="recipe_img/benchmark.png",
+                   cooking_time=self.random.randint(1, 120))
+            for i in range(options["recipes"])
+        )
+        recipes = list(Recipe.objects.values_list("id", flat=True))
+        self.recipes = recipes
+
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe_id=recipe, tag_id=tag.id)
+            for recipe in recipes
+            for tag in self.random.sample(self.tags,
+                                          min(2, len(self.tags)))
+        )
+        per_recipe = min(options["ingredients_per_recipe"],
+                         len(self.ingredients))
+        CountIngredient.objects.bulk_create(
+            (CountIngredient(recipe_id=recipe, ingredient_id=ingredient,
+                             amount=self.random.randint(1, 500))
+             for recipe in recipes
+             for ingredient in self.random.sample(self.ingredients,
+                                                  per_recipe)),
+            batch_size=1000,
+        )
+
+        favorites = min(options["favorites"], len(recipes))
+        carts = min(options["carts"], len(recipes))
+        subscriptions = min(options["subscriptions"], len(self.authors))
+        Favorite.objects.bulk_create(
+            (Favorite(user=user, recipe_id=recipe)
+             for user in users
+             for recipe in self.random.sample(recipes, favorites)),
+            batch_size=1000,
+        )
+        Cart.objects.bulk_create(
+            [Cart(user=self.user, recipe_id=recipe)
+             for recipe in recipes[:carts]]
+            + [Cart(user=self.small_user, recipe_id=recipe)
+               for recipe in recipes[:SMALL_CART]]
+        )
+        Subscribe.objects.bulk_create(
+            [Subscribe(user=self.user, author=author)
+             for author in self.authors[:subscriptions]]
+            + [Subscribe(user=self.small_user, author=author)
+               for author in self.authors[:SMALL_FOLLOWING]]
+        )
+        # bulk_create не трогает счетчики и рейтинги
+        call_command("recount_counters", stdout=io.StringIO())
+        call_command("compute_rankings", stdout=io.StringIO())
+
+        self.client = self.make_client(self.user)
+        self.small_client = self.make_client(self.small_user)
+        self.anon = APIClient(raise_request_exception=False)
+
+    def make_image(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), "orange").save(buffer, "PNG")
+        path = os.path.join(settings.MEDIA_ROOT, "recipe_img")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "benchmark.png"), "wb") as f:
+            f.write(buffer.getvalue())
+        encoded = base64.b64encode(buffer.getvalue()).decode()
+        return f"data:image/png;base64,{encoded}"
+
+    def make_client(self, user):
+        client = APIClient(raise_request_exception=False)
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        return client
+
+    def recipe_payload(self):
+        return {
+            "name": f"Новый рецепт {next(self.counter)}",
+            "text": "Описание",
+            "cooking_time": 10,
+            "image": self.image_payload,
+            "tags": [tag.id for tag in self.tags[:2]],
+            "ingredients": [{"id": ingredient, "amount": 5}
+                            for ingredient in self.ingredients[:5]],
+        }
+
+    # Сценарии
+
+    def cases(self):
+        """ (имя маршрута, метод, клиент, kwargs, query, тело) """
+        free = list(Recipe.objects.exclude(is_favorited__user=self.user)
+                    .exclude(in_carts__user=self.user)
+                    .values_list("id", flat=True)[:BATCH_SIZE + 1])
+        recipe, batch = free[0], {"recipes": free[1:]}
+        author = self.user.subscriptions.values_list("author",
+                                                     flat=True).first()
+        tag = self.tags[0]
+        ingredient = self.ingredients[0]
+        state = {}
+
+        def created_recipe():
+            return {"pk": state["recipe"]}
+
+        def login():
+            return {"email": self.spare_user.email, "password": PASSWORD}
+
+        def registration():
+            number = next(self.counter)
+            return {"email": f"new{number}@example.com",
+                    "username": f"new{number}", "first_name": "Новый",
+                    "last_name": "Пользователь", "password": PASSWORD}
+
+        def logout_client():
+            client = APIClient(raise_request_exception=False)
+            client.credentials(HTTP_AUTHORIZATION=f"Token {state['token']}")
+            return client
+
+        client, anon = self.client, self.anon
+        return (
+            ("api-root", "get", anon, {}, "", None),
+            ("login", "post", anon, {}, "", login),
+            ("logout", "post", logout_client, {}, "", None),
+            ("customuser-list", "get", client, {}, "?limit=6", None),
+            ("customuser-list", "get", anon, {}, "", None),
+            ("customuser-list", "get", client, {}, "?cursor=&limit=6", None),
+            ("customuser-list", "post", anon, {}, "", registration),
+            ("customuser-detail", "get", client, {"id": author}, "", None),
+            ("customuser-me", "get", client, {}, "", None),
+            ("customuser-subscribe", "delete", client, {"id": author},
+             "", None),
+            ("customuser-subscribe", "post", client, {"id": author},
+             "", None),
+            ("customuser-subscriptions", "get", client, {},
+             "?limit=6&recipes_limit=3", None),
+            ("customuser-subscriptions", "get", client, {},
+             "?recipes_limit=3", None),
+            ("customuser-set-password", "post", client, {}, "",
+             {"current_password": PASSWORD, "new_password": PASSWORD}),
+            ("customuser-set-username", "post", client, {}, "",
+             {"current_password": PASSWORD,
+              "new_username": self.user.username}),
+            ("customuser-activation", "post", anon, {}, "",
+             {"uid": "MQ", "token": "invalid"}),
+            ("customuser-resend-activation", "post", anon, {}, "",
+             {"email": self.spare_user.email}),
+            ("customuser-reset-password", "post", anon, {}, "",
+             {"email": self.spare_user.email}),
+            ("customuser-reset-password-confirm", "post", anon, {}, "",
+             {"uid": "MQ", "token": "invalid", "new_password": PASSWORD}),
+            ("customuser-reset-username", "post", anon, {}, "",
+             {"email": self.spare_user.email}),
+            ("customuser-reset-username-confirm", "post", anon, {}, "",
+             {"new_username": "renamed"}),
+            ("tag-list", "get", anon, {}, "", None),
+            ("tag-detail", "get", anon, {"pk": tag.id}, "", None),
+            ("ingredient-list", "get", anon, {}, "?name=соль", None),
+            ("ingredient-detail", "get", anon, {"pk": ingredient}, "",
+             None),
+            ("recipe-list", "get", anon, {}, "?page=1&limit=6", None),
+            ("recipe-list", "get", anon, {}, "?cursor=&limit=6", None),
+            ("recipe-list", "get", client, {},
+             f"?page=1&limit=6&tags={tag.slug}", None),
+            ("recipe-list", "get", client, {},
+             "?limit=6&is_favorited=1", None),
+            # Без ?limit= выдача идет списком, второй запрос - из кэша
+            ("recipe-list", "get", anon, {}, f"?tags={tag.slug}", None),
+            ("recipe-list", "get", client, {}, f"?tags={tag.slug}", None),
+            ("recipe-list", "get", anon, {},
+             "?page=1&limit=6&ordering=popular", None),
+            ("recipe-list", "get", client, {},
+             "?page=1&limit=6&ordering=trending", None),
+            # Курсор не листает рейтинг: ответ 400, а не выдача по дате
+            ("recipe-list", "get", anon, {},
+             "?cursor=&limit=6&ordering=popular", None),
+            ("recipe-list", "get", client, {},
+             "?cursor=&limit=6&ordering=trending", None),
+            ("recipe-list", "post", client, {}, "", self.recipe_payload),
+            ("recipe-feed", "get", client, {}, "?limit=6", None),
+            ("recipe-feed", "get", client, {}, "", None),
+            ("recipe-detail", "get", client, created_recipe, "", None),
+            ("recipe-detail", "patch", client, created_recipe, "",
+             self.recipe_payload),
+            ("recipe-detail", "delete", client, created_recipe, "", None),
+            ("recipe-favorite", "post", client, {"pk": recipe}, "", None),
+            ("recipe-favorite", "delete", client, {"pk": recipe}, "",
+             None),
+            ("recipe-shopping-cart", "post", client, {"pk": recipe}, "",
+             None),
+            ("recipe-shopping-cart", "delete", client, {"pk": recipe}, "",
+             None),
+            ("recipe-favorite-batch", "post", client, {}, "", batch),
+            ("recipe-favorite-batch", "delete", client, {}, "", batch),
+            ("recipe-shopping-cart-batch", "post", client, {}, "", batch),
+            ("recipe-shopping-cart-batch", "delete", client, {}, "", batch),
+            ("recipe-download-shopping-cart", "get", client, {}, "",
+             None),
+        ), state
+
+    # Замеры
+
+    def call(self, name, method, client, kwargs, query, data):
+        if callable(client):
+            client = client()
+        if callable(kwargs):
+            kwargs = kwargs()
+        if callable(data):
+            data = data()
+        url = reverse(f"api:{name}", kwargs=kwargs) + query
+        response = getattr(client, method)(url, data, format="json")
+        if getattr(response, "streaming", False):
+            b"".join(response.streaming_content)
+        return response
+
+    def remember(self, name, method, response, state):
+        if name == "recipe-list" and method == "post":
+            state["recipe"] = response.data["id"]
+        elif name == "login":
+            state["token"] = response.data["auth_token"]
+
+    def run_round(self, cases, state, profile=False):
+        """ Один проход по всем сценариям по порядку: POST и DELETE
+            идут парами, поэтому состояние базы после прохода не меняется.
+        """
+        rows = []
+        for name, method, client, kwargs, query, data in cases:
+            with CaptureQueriesContext(connection) as queries:
+                if profile:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                response = self.call(name, method, client, kwargs, query,
+                                     data)
+                elapsed = (time.perf_counter() - start) * 1000
+                peak = 0
+                if profile:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+            self.remember(name, method, response, state)
+            rows.append({
+                "name": name,
+                "query": query,
+                "method": method.upper(),
+                "status": response.status_code,
+                "queries": len(queries),
+                "elapsed": elapsed,
+                "peak": peak / 1024,
+            })
+        return rows
+
+    def measure(self):
+        cases, state = self.cases()
+        rounds = [self.run_round(cases, state)
+                  for _ in range(self.options["iterations"])]
+        results = self.run_round(cases, state, profile=True)
+        for index, row in enumerate(results):
+            timings = [rows[index]["elapsed"] for rows in rounds]
+            row["p50"] = percentile(timings or [row["elapsed"]], 0.5)
+            row["p95"] = percentile(timings or [row["elapsed"]], 0.95)
+            # В отчет идет худший код ответа за все проходы
+            row["status"] = max([rows[index]["status"] for rows in rounds]
+                                + [row["status"]])
+        return results
+
+    def report(self, results):
+        header = (f"{'маршрут':<56} {'метод':<7} {'код':>4} "
+                  f"{'запросы':>8} {'p50 мс':>8} {'p95 мс':>8} "
+                  f"{'пик КБ':>9}")
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+        for row in results:
+            self.stdout.write(
+                f"{row['name'] + row['query']:<56.56} {row['method']:<7} "
+                f"{row['status']:>4} "
+                f"{row['queries']:>8} {row['p50']:>8.1f} {row['p95']:>8.1f} "
+                f"{row['peak']:>9.1f}"
+            )
+
+    def check_errors(self, results):
+        failed = [f"{row['method']} {row['name']}{row['query']}: "
+                  f"{row['status']}"
+                  for row in results if row["status"] >= 500]
+        if failed:
+            raise CommandError(
+                "Сервер ответил ошибкой 5xx:\n" + "\n".join(failed)
+            )
+
+    def check_coverage(self, results):
+        missing = route_names(api_urls.urlpatterns) - {
+            row["name"] for row in results
+        }
+        if missing:
+            raise CommandError(
+                f"Нет сценария для маршрутов: {', '.join(sorted(missing))}"
+            )
+
+    def count_queries(self, client, name, query, kwargs=None):
+        # Закэшированный COUNT исказил бы сравнение страниц, а токен
+        # из кэша процесса - число запросов на аутентификацию
+        cache.clear()
+        caches[PAGE_CACHE_ALIAS].clear()
+        token_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.call(name, "get", client, kwargs or {}, query, None)
+        return len(queries)
+
+    def check_scaling(self):
+        """ Число запросов не должно зависеть от размера страницы/корзины """
+        slug = self.tags[0].slug
+        checks = (
+            ("recipe-list: размер страницы", self.anon, "recipe-list",
+             "?limit={}"),
+            ("recipe-list: фильтр по тэгу", self.client, "recipe-list",
+             f"?tags={slug}&limit={{}}"),
+            ("recipe-list: избранное", self.client, "recipe-list",
+             "?is_favorited=1&limit={}"),
+            ("customuser-list: размер страницы", self.client,
+             "customuser-list", "?limit={}"),
+            ("customuser-subscriptions: размер страницы", self.client,
+             "customuser-subscriptions", "?limit={}&recipes_limit=3"),
+            ("customuser-subscriptions: recipes_limit", self.client,
+             "customuser-subscriptions", "?limit=6&recipes_limit={}"),
+            ("recipe-feed: размер страницы", self.client, "recipe-feed",
+             "?limit={}"),
+            ("recipe-list: курсор", self.client, "recipe-list",
+             f"?cursor=&tags={slug}&limit={{}}"),
+            ("recipe-list: популярные", self.client, "recipe-list",
+             "?ordering=popular&limit={}"),
+        )
+        failures = []
+        for label, client, name, query in checks:
+            small = self.count_queries(client, name,
+                                       query.format(SMALL_PAGE))
+            large = self.count_queries(client, name,
+                                       query.format(LARGE_PAGE))
+            if small != large:
+                failures.append(f"{label}: {small} -> {large}")
+
+        small = self.count_queries(self.small_client,
+                                   "recipe-download-shopping-cart", "")
+        large = self.count_queries(self.client,
+                                   "recipe-download-shopping-cart", "")
+        if small != large:
+            failures.append(f"download_shopping_cart: {small} -> {large}")
+
+        small = self.count_queries(self.small_client,
+                                   "customuser-subscriptions",
+                                   "?limit=6&recipes_limit=3")
+        large = self.count_queries(self.client, "customuser-subscriptions",
+                                   "?limit=6&recipes_limit=3")
+        if small != large:
+            failures.append(f"subscriptions: число авторов {small} -> {large}")
+
+        if failures:
+            raise CommandError(
+                "Число запросов растет с размером выборки (N+1):\n"
+                + "\n".join(failures)
+            )
+        self.stdout.write(self.style.SUCCESS(
+            "Число запросов не зависит от размера страниц и корзины."
+        ))
@@ -0,0 +1,67 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from api.cache import RECIPES_NAMESPACE, bump_stamp
+from api.core import RANKING_SIZE, TRENDING_WINDOW_DAYS
+from recipes.models import Cart, Favorite, Recipe, RecipeRanking
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the recipe_ranking table used by '
+            '?ordering=popular|trending. Run it periodically, e.g. '
+            'from cron every few minutes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=TRENDING_WINDOW_DAYS,
+                            help='Trending window in days')
+        parser.add_argument('--limit', type=int, default=RANKING_SIZE,
+                            help='How many recipes each ranking keeps')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        limit = options['limit']
+        rankings = {
+            RecipeRanking.POPULAR: self.popular(limit),
+            RecipeRanking.TRENDING: self.trending(
+                now - timedelta(days=options['days']), limit
+            ),
+        }
+        with transaction.atomic():
+            RecipeRanking.objects.all().delete()
+            RecipeRanking.objects.bulk_create(
+                RecipeRanking(kind=kind, recipe_id=recipe, score=score,
+                              position=position, computed_at=now)
+                for kind, scores in rankings.items()
+                for position, (recipe, score) in enumerate(scores, 1)
+            )
+            transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+        for kind, scores in rankings.items():
+            self.stdout.write(f'{kind}: {len(scores)}')
+
+    def popular(self, limit):
+        """ По числу добавлений в избранное за все время """
+        return list(
+            Recipe.objects.filter(favorites_count__gt=0)
+            .order_by('-favorites_count', '-pub_date', '-id')
+            .values_list('id', 'favorites_count')[:limit]
+        )
+
+    def trending(self, since, limit):
+        """ По избранному и спискам покупок за последние дни """
+        scores = Counter()
+        for model, date_field in ((Favorite, 'date_added'),
+                                  (Cart, 'date_add')):
+            scores.update(dict(
+                model.objects.filter(**{f'{date_field}__gte': since})
+                .order_by().values('recipe')
+                .annotate(total=Count('id'))
+                .values_list('recipe', 'total')
+            ))
+        return sorted(scores.items(),
+                      key=lambda item: (-item[1], -item[0]))[:limit]
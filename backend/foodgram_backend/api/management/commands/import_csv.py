@@ -1,21 +1,131 @@
 import csv
-from django.core.management.base import BaseCommand
+import json
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.core import MAX_LENGTH_NAME_INGR, MAX_LENGTH_MEASUR_UNIT
+from api.search import invalidate_ingredient_index
 from recipes.models import Ingredient
 
+CHUNK_SIZE = 1000
+JSON_BLOCK_SIZE = 64 * 1024
+
+
+def read_csv(f):
+    for row in csv.reader(f):
+        if len(row) < 2:
+            yield None, None
+            continue
+        yield row[0], row[1]
+
+
+def read_json(f):
+    """ Reads a JSON array of objects block by block,
+        so the whole file is never loaded into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(JSON_BLOCK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('JSON file must contain an array of objects')
+    buffer = buffer[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise CommandError('JSON file is truncated or malformed')
+            block = f.read(JSON_BLOCK_SIZE)
+            eof = not block
+            buffer += block
+            continue
+        buffer = buffer[end:]
+        if not isinstance(item, dict):
+            yield None, None
+            continue
+        yield item.get('name'), item.get('measurement_unit')
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+}
+
 
 class Command(BaseCommand):
-    help = 'Import CSV data into MyModel'
+    help = ('Import ingredients from a CSV (name,measurement_unit) '
+            'or JSON file. Existing names get their measurement unit '
+            'updated, so the import can be re-run safely.')
 
     def add_arguments(self, parser):
-        parser.add_argument('csv_file', type=str, help='The path to the CSV')
+        parser.add_argument('csv_file', type=str,
+                            help='The path to the CSV or JSON file')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='How many rows to write per batch')
 
     def handle(self, *args, **options):
-        csv_file = options['csv_file']
-        with open(csv_file, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(Ingredient.objects.filter(name=row[0])) == 0:
-                    ingredient = Ingredient()
-                    ingredient.name = row[0]
-                    ingredient.measurement_unit = row[1]
-                    ingredient.save()
+        path = Path(options['csv_file'])
+        reader = READERS.get(path.suffix.lower())
+        if reader is None:
+            raise CommandError('Only .csv and .json files are supported')
+
+        self.inserted = self.updated = self.skipped = 0
+        self.seen = set()
+        with open(path, 'r', encoding='utf-8') as f, transaction.atomic():
+            rows = reader(f)
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                self.import_chunk(chunk)
+        invalidate_ingredient_index()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Inserted: {self.inserted}, updated: {self.updated}, '
+            f'skipped: {self.skipped}'
+        ))
+
+    def clean_chunk(self, chunk):
+        """ Drops malformed rows and names repeated in the file """
+        rows = {}
+        for name, measurement_unit in chunk:
+            name = (name or '').strip()
+            measurement_unit = (measurement_unit or '').strip()
+            if (not name or not measurement_unit
+                    or len(name) > MAX_LENGTH_NAME_INGR
+                    or len(measurement_unit) > MAX_LENGTH_MEASUR_UNIT
+                    or name in self.seen):
+                self.skipped += 1
+                continue
+            self.seen.add(name)
+            rows[name] = measurement_unit
+        return rows
+
+    def import_chunk(self, chunk):
+        rows = self.clean_chunk(chunk)
+        existing = Ingredient.objects.in_bulk(rows, field_name='name')
+
+        to_create = []
+        to_update = []
+        for name, measurement_unit in rows.items():
+            ingredient = existing.get(name)
+            if ingredient is None:
+                to_create.append(Ingredient(
+                    name=name, measurement_unit=measurement_unit
+                ))
+            elif ingredient.measurement_unit != measurement_unit:
+                ingredient.measurement_unit = measurement_unit
+                to_update.append(ingredient)
+            else:
+                self.skipped += 1
+
+        Ingredient.objects.bulk_create(to_create, ignore_conflicts=True)
+        Ingredient.objects.bulk_update(to_update, ('measurement_unit',))
+        self.inserted += len(to_create)
+        self.updated += len(to_update)
@@ -0,0 +1,75 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from api.core import IMAGE_CLAIM_TIMEOUT
+from recipes.models import Recipe
+from recipes.tasks import process_recipe_image
+
+
+class Command(BaseCommand):
+    help = ('Processes recipe images waiting in the database queue '
+            '(image_status=pending). Images stuck in processing longer '
+            'than --stale-after seconds (the worker died) are queued '
+            'again. Use --watch to keep polling, e.g. with '
+            'IMAGE_PROCESSING_BROKER=database. With the thread broker, '
+            'run it after restarts (or from cron): jobs lost with the '
+            'process are only picked up here.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep polling for new images')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds between polls with --watch')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Put failed images back into the queue')
+        parser.add_argument('--stale-after', type=float,
+                            default=IMAGE_CLAIM_TIMEOUT,
+                            help='Seconds after which an image in '
+                                 'processing is queued again')
+        parser.add_argument('--missing-variants', action='store_true',
+                            help='Put processed images without resized '
+                                 'variants back into the queue, e.g. '
+                                 'recipes created before image_variants')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            Recipe.objects.filter(
+                image_status=Recipe.IMAGE_FAILED
+            ).update(image_status=Recipe.IMAGE_PENDING)
+        if options['missing_variants']:
+            Recipe.objects.filter(
+                image_status=Recipe.IMAGE_DONE, image_variants={}
+            ).exclude(image='').update(image_status=Recipe.IMAGE_PENDING)
+
+        while True:
+            self.requeue_stale(options['stale_after'])
+            done = failed = 0
+            pending = Recipe.objects.filter(
+                image_status=Recipe.IMAGE_PENDING
+            ).values_list('pk', flat=True)
+            for recipe_id in pending.iterator():
+                if process_recipe_image(recipe_id):
+                    done += 1
+                elif Recipe.objects.filter(
+                    pk=recipe_id, image_status=Recipe.IMAGE_FAILED
+                ).exists():
+                    failed += 1
+            if done or failed:
+                self.stdout.write(f'Processed: {done}, failed: {failed}')
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
+
+    def requeue_stale(self, stale_after):
+        """ Возвращает в очередь картинки, брошенные умершим воркером """
+        cutoff = timezone.now() - timedelta(seconds=stale_after)
+        stale = Recipe.objects.filter(
+            Q(image_claimed_at__lt=cutoff) | Q(image_claimed_at=None),
+            image_status=Recipe.IMAGE_PROCESSING,
+        ).update(image_status=Recipe.IMAGE_PENDING)
+        if stale:
+            self.stdout.write(f'Requeued stale: {stale}')
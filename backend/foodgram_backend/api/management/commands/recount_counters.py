@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Cart, Favorite, Recipe
+from users.models import Subscribe
+
+User = get_user_model()
+
+# (модель, счетчик, что считаем, поле связи)
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', Cart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscribers_count', Subscribe, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Recomputes denormalized counters (favorites_count, '
+            'in_carts_count, recipes_count, subscribers_count) and '
+            'fixes rows that drifted, e.g. after admin edits.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows drifted')
+
+    def handle(self, *args, **options):
+        for model, field, related, lookup in COUNTERS:
+            actual = Coalesce(Subquery(
+                related.objects.filter(**{lookup: OuterRef('pk')})
+                .order_by().values(lookup)
+                .annotate(total=Count('pk')).values('total')
+            ), 0)
+            drifted = model.objects.exclude(**{field: actual})
+            if options['dry_run']:
+                fixed = drifted.count()
+            else:
+                with transaction.atomic():
+                    fixed = drifted.update(**{field: actual})
+            self.stdout.write(f'{model.__name__}.{field}: {fixed}')
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.search import in_memory_search, use_in_memory_index
+
+
+class Command(BaseCommand):
+    help = ('Builds the in-memory ingredient autocomplete index. '
+            'Call it from a gunicorn post_fork hook (or set '
+            'INGREDIENT_INDEX_WARM_ON_START) so the first keystroke '
+            'does not pay for loading the catalog.')
+
+    def handle(self, *args, **options):
+        if not use_in_memory_index():
+            self.stdout.write('The in-memory index is off (PostgreSQL with '
+                              'INGREDIENT_INDEX_ENABLED=False), '
+                              'nothing to do')
+            return
+        start = time.perf_counter()
+        size = in_memory_search.warm()
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {size} ingredients in {elapsed:.1f} ms'
+        ))
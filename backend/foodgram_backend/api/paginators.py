@@ -1,14 +1,283 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import md5
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import (EmptyPage, Page, PageNotAnInteger,
+                                   Paginator)
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+COUNT_CACHE_TIMEOUT = 30
+COUNT_ESTIMATE_THRESHOLD = 10_000
+
+COUNT_EXACT = "exact"
+COUNT_CACHED = "cached"
+COUNT_ESTIMATED = "estimated"
+
+
+class CountingPage(Page):
+    """ Страница, которая знает, есть ли следующая, без точного count """
+    more = None
+
+    def has_next(self):
+        if self.more is None:
+            return super().has_next()
+        return self.more
+
+
+class CountingPaginator(Paginator):
+    """ Paginator, который не считает COUNT(*) на каждый запрос.
+
+        Число строк кэшируется по ключу фильтров на count_timeout
+        секунд. На PostgreSQL сначала берется оценка планировщика, и
+        если строк больше COUNT_ESTIMATE_THRESHOLD, точный COUNT не
+        выполняется. Каким способом получено число, видно в count_mode.
+
+        Если число не посчитано только что, оно может отличаться от
+        настоящего, поэтому страница выбирается без оглядки на count,
+        а наличие следующей определяется по лишней строке выборки.
+    """
+
+    def __init__(self, object_list, per_page, count_key=None,
+                 count_timeout=0, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key if count_timeout else None
+        self.count_timeout = count_timeout
+        self.count_mode = COUNT_EXACT
+
+    @cached_property
+    def count(self):
+        if self.count_key is not None:
+            cached = cache.get(self.count_key)
+            if cached is not None:
+                self.count_mode = COUNT_CACHED
+                return cached
+
+        count = self.estimate_count()
+        if count is not None and count >= COUNT_ESTIMATE_THRESHOLD:
+            self.count_mode = COUNT_ESTIMATED
+        else:
+            count = self.object_list.count()
+        if self.count_key is not None:
+            cache.set(self.count_key, count, self.count_timeout)
+        return count
+
+    def estimate_count(self):
+        """ Оценка числа строк из EXPLAIN, только для PostgreSQL """
+        if not isinstance(self.object_list, QuerySet):
+            return None
+        connection = connections[self.object_list.db]
+        if connection.vendor != "postgresql":
+            return None
+        sql, params = self.object_list.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @property
+    def exact(self):
+        return self.count is not None and self.count_mode == COUNT_EXACT
+
+    def validate_number(self, number):
+        if self.exact:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("Номер страницы должен быть числом.")
+        if number < 1:
+            raise EmptyPage("Номер страницы меньше 1.")
+        return number
+
+    def page(self, number):
+        if self.exact:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage("На этой странице нет результатов.")
+        page = self._get_page(rows[:self.per_page], number, self)
+        page.more = len(rows) > self.per_page
+        return page
+
+    def _get_page(self, *args, **kwargs):
+        return CountingPage(*args, **kwargs)
 
 
 class CustomPagination(PageNumberPagination):
+    """ Постраничная выдача ?page=&limit=, как ждет фронтенд.
+
+        Если в запросе есть ?cursor= (для первой страницы - пустой),
+        выдача идет через KeysetPagination по keyset_ordering
+        представления: без COUNT(*) и без OFFSET.
+        Представление может включить кэш числа строк атрибутом
+        count_cache_timeout.
+    """
     page_size_query_param = "limit"
+    cursor_query_param = "cursor"
+    keyset = None
+    count_timeout = 0
+
+    def django_paginator_class(self, object_list, per_page):
+        return CountingPaginator(object_list, per_page,
+                                 count_key=self.get_count_key(self.request),
+                                 count_timeout=self.count_timeout)
+
+    def get_count_key(self, request):
+        """ Ключ числа строк: путь, фильтры и пользователь,
+            без номера и размера страницы.
+        """
+        skip = (self.page_query_param, self.page_size_query_param)
+        query = "&".join(sorted(
+            f"{key}={value}"
+            for key, values in request.query_params.lists()
+            if key not in skip
+            for value in values
+        ))
+        user = request.user.pk if request.user.is_authenticated else ""
+        fingerprint = md5(f"{request.path}?{query}".encode()).hexdigest()
+        return f"count:{user}:{fingerprint}"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.count_timeout = getattr(view, "count_cache_timeout", 0)
+        ordering = getattr(view, "keyset_ordering", None)
+        if ordering and self.cursor_query_param in request.query_params:
+            self.keyset = KeysetPagination()
+            self.keyset.ordering = ordering
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return Response({
+            "count": self.page.paginator.count,
+            "count_mode": self.page.paginator.count_mode,
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        })
 
 
 class NoPagination(PageNumberPagination):
     page_size = 10000
 
 
-class RecipePagination(PageNumberPagination):
-    page_size = 2
-    page_size_query_param = "recipes_limit"
+class KeysetPagination(BasePagination):
+    """ Пагинация по ключу сортировки (keyset).
+
+        Вместо OFFSET в курсоре лежат значения полей ordering у последней
+        строки страницы, и следующая страница выбирается условием
+        (pub_date, id) < (курсор). Поэтому глубокая прокрутка стоит
+        столько же, сколько первая страница. Последнее поле ordering
+        должно быть уникальным.
+    """
+    ordering = ("-pub_date", "-id")
+    page_size = 6
+    max_page_size = 100
+    page_size_query_param = "limit"
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Неверный курсор."
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        fields = [queryset.model._meta.get_field(name.lstrip("-"))
+                  for name in self.ordering]
+
+        position, reverse = self.decode_cursor(request, fields)
+        ordering = self.ordering
+        if reverse:
+            ordering = [self.invert(name) for name in ordering]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(ordering, position))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        page = rows[:self.page_size]
+        if reverse:
+            page.reverse()
+
+        self.next_position = self.previous_position = None
+        if page:
+            if reverse:
+                has_next, has_previous = True, has_more
+            else:
+                has_next, has_previous = has_more, position is not None
+            if has_next:
+                self.next_position = self.position_of(page[-1], fields)
+            if has_previous:
+                self.previous_position = self.position_of(page[0], fields)
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_link(self.next_position, False),
+            "previous": self.get_link(self.previous_position, True),
+            "results": data,
+        })
+
+    @staticmethod
+    def invert(name):
+        return name[1:] if name.startswith("-") else f"-{name}"
+
+    @staticmethod
+    def after(ordering, position):
+        """ Строки, идущие после position при сортировке ordering """
+        condition = Q()
+        equal = Q()
+        for name, value in zip(ordering, position):
+            field = name.lstrip("-")
+            lookup = "lt" if name.startswith("-") else "gt"
+            condition |= equal & Q(**{f"{field}__{lookup}": value})
+            equal &= Q(**{field: value})
+        return condition
+
+    def position_of(self, obj, fields):
+        return [field.value_to_string(obj) for field in fields]
+
+    def decode_cursor(self, request, fields):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            payload = json.loads(urlsafe_b64decode(cursor.encode()))
+            values = payload["p"]
+            if len(values) != len(fields):
+                raise ValueError
+            position = [field.to_python(value)
+                        for field, value in zip(fields, values)]
+            return position, bool(payload.get("r"))
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_link(self, position, reverse):
+        if position is None:
+            return None
+        payload = {"p": position}
+        if reverse:
+            payload["r"] = 1
+        cursor = urlsafe_b64encode(json.dumps(payload).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   cursor)
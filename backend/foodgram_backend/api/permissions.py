@@ -21,7 +21,7 @@ class AuthorStaffOrReadOnly(IsAuthPermission):
 class AdminOrReadOnly(IsAuthPermission):
     """ Изменение только для авторов """
 
-    def has_object_permission(self, request, view):
+    def has_object_permission(self, request, view, obj):
         return (request.method in SAFE_METHODS
                 or request.user.is_authenticated
                 and request.user.is_staff)
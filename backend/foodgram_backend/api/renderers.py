@@ -0,0 +1,124 @@
+import csv
+import tempfile
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+PDF_FONT_NAME = "ShoppingCartFont"
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+PDF_LINE_HEIGHT = 18
+PDF_CHUNK_SIZE = 64 * 1024
+# Больше этого готовый PDF пишется во временный файл на диске
+PDF_SPOOL_SIZE = 1024 * 1024
+
+
+class ShoppingCartRenderer(BaseRenderer):
+    """ Базовый рендерер списка покупок.
+
+        Сам файл отдается генератором stream(). Ошибки представление
+        отдает через JSONRenderer, render() - лишь запасной вариант.
+    """
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data, accepted_media_type,
+                                     renderer_context)
+
+    def stream(self, ingredients):
+        """ Принимает итератор кортежей (название, единица, количество) """
+        raise NotImplementedError
+
+
+class ShoppingCartNegotiation(DefaultContentNegotiation):
+    """ Формат файла задается только через ?format=, по умолчанию txt.
+
+        Заголовок Accept не учитывается: клиент с Accept:
+        application/json получает файл, а не 406.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        format_query_param = self.settings.URL_FORMAT_OVERRIDE
+        format = format_suffix or request.query_params.get(format_query_param)
+        if format:
+            renderers = self.filter_renderers(renderers, format)
+        renderer = renderers[0]
+        return renderer, renderer.media_type
+
+
+class ShoppingCartTextRenderer(ShoppingCartRenderer):
+    media_type = "text/plain"
+    format = "txt"
+
+    def stream(self, ingredients):
+        for name, measurement_unit, amount in ingredients:
+            yield f"{name} ({measurement_unit}) - {amount}\n"
+
+
+class Echo:
+    """ Псевдо-буфер для csv.writer: возвращает строку вместо записи """
+
+    def write(self, value):
+        return value
+
+
+class ShoppingCartCSVRenderer(ShoppingCartRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+    def stream(self, ingredients):
+        writer = csv.writer(Echo())
+        yield writer.writerow(("Ингредиент", "Единица измерения",
+                               "Количество"))
+        for row in ingredients:
+            yield writer.writerow(row)
+
+
+class ShoppingCartPDFRenderer(ShoppingCartRenderer):
+    media_type = "application/pdf"
+    format = "pdf"
+    charset = None
+
+    def get_font(self):
+        """ Для кириллицы нужен TTF-шрифт, иначе берем Helvetica """
+        if PDF_FONT_NAME in pdfmetrics.getRegisteredFontNames():
+            return PDF_FONT_NAME
+        try:
+            pdfmetrics.registerFont(
+                TTFont(PDF_FONT_NAME, settings.SHOPPING_CART_PDF_FONT)
+            )
+        except Exception:
+            return "Helvetica"
+        return PDF_FONT_NAME
+
+    def stream(self, ingredients):
+        """ PDF не стримится: ReportLab пишет документ целиком в
+            pdf.save(), и первый байт уходит после последней страницы.
+            Готовый файл не держится в памяти, а читается кусками
+            из временного файла.
+        """
+        font = self.get_font()
+        with tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE) as output:
+            pdf = canvas.Canvas(output, pagesize=A4, pageCompression=1)
+            width, height = A4
+            top = height - PDF_MARGIN
+            y = top
+            pdf.setFont(font, PDF_FONT_SIZE)
+
+            for name, measurement_unit, amount in ingredients:
+                if y < PDF_MARGIN:
+                    pdf.showPage()
+                    pdf.setFont(font, PDF_FONT_SIZE)
+                    y = top
+                pdf.drawString(PDF_MARGIN, y,
+                               f"{name} ({measurement_unit}) - {amount}")
+                y -= PDF_LINE_HEIGHT
+
+            pdf.save()
+            output.seek(0)
+            yield from iter(lambda: output.read(PDF_CHUNK_SIZE), b"")
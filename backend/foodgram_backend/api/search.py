@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Case, IntegerField, Value, When
+from django.db.models.functions import Lower
+
+from api.cache import bump_stamp, get_stamp
+from recipes.models import Ingredient
+
+INGREDIENTS_NAMESPACE = "ingredients"
+
+
+class DatabaseIngredientSearch:
+    """ Поиск силами БД, если индекс в памяти выключен.
+
+        На PostgreSQL LIKE по lower(name) идет по индексам из миграции:
+        text_pattern_ops для префикса и pg_trgm для подстроки.
+    """
+
+    def search(self, query, limit):
+        return list(
+            Ingredient.objects
+            .annotate(name_lower=Lower("name"))
+            .filter(name_lower__contains=query)
+            .annotate(rank=Case(
+                When(name_lower__startswith=query, then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            ))
+            .order_by("rank", "name")[:limit]
+        )
+
+
+class InMemoryIngredientSearch:
+    """ Отсортированный массив ингредиентов в памяти процесса.
+
+        Строится лениво при первом обращении и хранит сами объекты
+        Ingredient, поэтому поиск и выдача по id идут без запросов к БД.
+        Префикс ищется бинарным поиском, подстрока - проходом по массиву.
+        Сбрасывается сигналами post_save/post_delete модели Ingredient.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.index = ([], [], {}, [])
+
+    def build(self, version):
+        ingredients = list(Ingredient.objects.order_by("name"))
+        entries = sorted(
+            ((ingredient.name.lower(), ingredient.pk), ingredient)
+            for ingredient in ingredients
+        )
+        # Подменяем кортеж целиком, чтобы параллельные запросы
+        # не увидели наполовину собранный индекс.
+        self.index = (
+            [name for (name, _), _ in entries],
+            [ingredient for _, ingredient in entries],
+            {ingredient.pk: ingredient for ingredient in ingredients},
+            ingredients,
+        )
+        self.version = version
+
+    def ensure_fresh(self):
+        version, _ = get_stamp(INGREDIENTS_NAMESPACE)
+        if self.version != version:
+            with self.lock:
+                if self.version != version:
+                    self.build(version)
+        return self.index
+
+    def clear(self):
+        self.version = None
+
+    def warm(self):
+        _, _, by_id, _ = self.ensure_fresh()
+        return len(by_id)
+
+    def all(self):
+        _, _, _, by_name = self.ensure_fresh()
+        return by_name
+
+    def get(self, pk):
+        _, _, by_id, _ = self.ensure_fresh()
+        return by_id.get(pk)
+
+    def search(self, query, limit):
+        names, ingredients, _, _ = self.ensure_fresh()
+        found = []
+        start = bisect_left(names, query)
+        index = start
+        while (index < len(names) and len(found) < limit
+               and names[index].startswith(query)):
+            found.append(ingredients[index])
+            index += 1
+        prefix_end = index
+
+        for index, name in enumerate(names):
+            if len(found) >= limit:
+                break
+            if start <= index < prefix_end:
+                continue
+            if query in name:
+                found.append(ingredients[index])
+        return found
+
+
+database_search = DatabaseIngredientSearch()
+in_memory_search = InMemoryIngredientSearch()
+
+
+def use_in_memory_index():
+    """ Выключить индекс можно только на PostgreSQL: на остальных БД
+        lower() и LIKE не сворачивают регистр кириллицы.
+    """
+    if settings.INGREDIENT_INDEX_ENABLED:
+        return True
+    db = router.db_for_read(Ingredient)
+    return connections[db].vendor != "postgresql"
+
+
+def invalidate_ingredient_index():
+    """ Сбрасывает индекс в этом процессе и меняет версию в кэше,
+        по которой индекс и кэш ответов обновят остальные процессы.
+    """
+    in_memory_search.clear()
+    bump_stamp(INGREDIENTS_NAMESPACE)
+
+
+def search_ingredients(query, limit):
+    """ Ингредиенты, где префиксные совпадения идут раньше остальных """
+    query = query.strip().lower()
+    if use_in_memory_index():
+        return in_memory_search.search(query, limit)
+    return database_search.search(query, limit)
@@ -1,15 +1,30 @@
+import json
+
 from django.contrib.auth import get_user_model
-from drf_extra_fields.fields import Base64ImageField
 from django.core.exceptions import ValidationError
-from rest_framework.serializers import (ModelSerializer,
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import QueryDict
+from rest_framework.exceptions import ValidationError as DRFValidationError
+from rest_framework.serializers import (IntegerField,
+                                        ListField,
+                                        ModelSerializer,
+                                        Serializer,
                                         SerializerMethodField,
                                         EmailField,
                                         CharField,)
+from rest_framework.settings import api_settings
 
 from api.core import (id_and_amount_pull_out_from_dict,
+                      insert_or_ignore,
                       make_new_count_ingr,
+                      update_count_ingr,
+                      MAX_BATCH_RECIPES,
                       MAX_COUNT_INGR,
+                      MIN_COUNT_INGR,
                       )
+from api.fields import StreamingBase64ImageField
+from api.state import get_user_state
 from recipes.models import Favorite, Recipe, Tag, Ingredient, CountIngredient
 from users.models import Subscribe
 
@@ -17,6 +32,29 @@ from users.models import Subscribe
 User = get_user_model()
 
 
+def get_image_variant_urls(recipe, request):
+    """ Ссылки на уменьшенные копии картинки рецепта """
+    urls = {}
+    for variant, name in recipe.image_variants.items():
+        url = default_storage.url(name)
+        urls[variant] = request.build_absolute_uri(url) if request else url
+    return urls
+
+
+def already_exists(message):
+    """ Ошибка повторной вставки в том же виде, что и ошибки validate() """
+    return DRFValidationError({api_settings.NON_FIELD_ERRORS_KEY: [message]})
+
+
+def get_recipes_limit(request):
+    """ ?recipes_limit= из запроса, None - показывать все рецепты """
+    try:
+        recipes_limit = int(request.query_params["recipes_limit"])
+    except (KeyError, ValueError):
+        return None
+    return max(recipes_limit, 0)
+
+
 class CustomUserSerializer(ModelSerializer):
     email = EmailField(required=True)
     first_name = CharField(required=True)
@@ -38,10 +76,7 @@ class CustomUserSerializer(ModelSerializer):
         extra_kwargs = {"password": {"write_only": True}}
 
     def get_is_subscribed(self, obj):
-        user = self.context["request"].user
-        if user.is_anonymous or (user == obj):
-            return False
-        return user.subscriptions.filter(author=obj).exists()
+        return get_user_state(self.context["request"]).is_subscribed(obj.pk)
 
     def create(self, validated_data):
         user = User(
@@ -92,7 +127,8 @@ class RecipeSerializer(ModelSerializer):
     is_in_shopping_cart = SerializerMethodField()
     tags = TagSerializer(many=True, read_only=True)
     author = CustomUserSerializer(read_only=True)
-    image = Base64ImageField()
+    image = StreamingBase64ImageField()
+    image_variants = SerializerMethodField()
 
     class Meta:
         model = Recipe
@@ -104,6 +140,7 @@ class RecipeSerializer(ModelSerializer):
                   "is_in_shopping_cart",
                   "name",
                   "image",
+                  "image_variants",
                   "text",
                   "cooking_time")
         read_only_fields = (
@@ -111,89 +148,168 @@ class RecipeSerializer(ModelSerializer):
             "is_in_shopping_cart",
         )
 
+    def get_image_variants(self, obj):
+        return get_image_variant_urls(obj, self.context.get("request"))
+
     def get_ingredients(self, obj):
         return IngredientAmountSerializer(obj.amount, many=True).data
 
     def get_is_favorited(self, obj):
-        user = self.context["request"].user
-        if user.is_authenticated:
-            return obj.is_favorited.filter(user=user).exists()
-        return False
+        return get_user_state(self.context["request"]).is_favorited(obj.pk)
 
     def get_is_in_shopping_cart(self, recipe):
-        user = self.context["view"].request.user
-        if user.is_anonymous:
-            return False
-        return user.in_carts.filter(recipe=recipe).exists()
+        state = get_user_state(self.context["request"])
+        return state.is_in_shopping_cart(recipe.pk)
+
+    def get_initial_list(self, name):
+        """ Список из JSON или из multipart-формы.
+
+            В форме теги приходят повторяющимся полем, а ингредиенты -
+            JSON-строкой.
+        """
+        if not isinstance(self.initial_data, QueryDict):
+            return self.initial_data.get(name)
+        values = self.initial_data.getlist(name)
+        if len(values) == 1 and values[0].lstrip().startswith("["):
+            try:
+                return json.loads(values[0])
+            except ValueError:
+                raise ValidationError(f"Поле {name} должно быть списком.")
+        return values
 
     def validate(self, data):
-        id_tags = self.initial_data["tags"]
-        data_ingredients = self.initial_data.get("ingredients")
+        """ Проверка рецепта за постоянное число запросов: ингредиенты
+            и тэги достаются по id одним запросом каждый, все
+            ненайденные id перечисляются в одной ошибке.
+        """
+        id_tags = self.get_initial_list("tags")
+        data_ingredients = self.get_initial_list("ingredients")
         author = self.context["request"].user
         method = self.context["request"].method
 
-        if Recipe.objects.filter(
-            name=data["name"], author=author
-        ).exists() and method == "POST":
+        if not data_ingredients or not id_tags:
+            raise ValidationError("Заполните все поля и картинку не забудьте!")
+
+        if method == "POST" and Recipe.objects.filter(
+            name=data.get("name"), author=author
+        ).exists():
             raise ValidationError(
                 "Рецепт с таким названием уже существует у вас."
             )
 
-        if not data_ingredients or not id_tags:
-            raise ValidationError("Заполните все поля и картинку не забудьте!")
+        list_id_amount = self.parse_ingredients(data_ingredients)
+        tags = self.resolve_tags(id_tags)
+        data.update(
+            {
+                "ingredients": list_id_amount,
+                "tags": tags,
+            }
+        )
+        return data
 
+    def parse_ingredients(self, data_ingredients):
+        """ Пары (Ingredient, amount) одним запросом .in_bulk() """
+        pairs = []
         for ingredient in data_ingredients:
-            amount = ingredient["amount"]
             try:
-                amount = int(amount)
+                pk = int(ingredient["id"])
+                amount = int(ingredient["amount"])
+            except (KeyError, TypeError):
+                raise ValidationError(
+                    {"ingredients": "Укажите id и amount ингредиента."}
+                )
             except ValueError:
                 raise ValidationError("Кол-ство должно быть числом.")
-            if amount > MAX_COUNT_INGR:
-                raise ValidationError("Кол-ство не должно превышать 32 000.")
-
-        list_id_amount = id_and_amount_pull_out_from_dict(Ingredient,
-                                                          data_ingredients)
-
-        # Нахождение тэгов
-        tags_obj = Tag.objects.filter(id__in=id_tags)
-        if not tags_obj.exists():
-            raise ValueError("Такого тэга нет")
+            pairs.append((pk, amount))
 
-        data.update(
-            {
-                "ingredients": list_id_amount,
-                "tags": tags_obj,
-            }
+        list_id_amount, missing = id_and_amount_pull_out_from_dict(
+            Ingredient, pairs
         )
-        return data
+        if missing:
+            raise ValidationError({"ingredients": (
+                "Нет ингредиентов с id: "
+                + ", ".join(str(pk) for pk in missing)
+            )})
+        for _, amount in list_id_amount:
+            if amount < MIN_COUNT_INGR:
+                raise ValidationError("Кол-ство должно быть больше нуля.")
+            if amount > MAX_COUNT_INGR:
+                raise ValidationError("Кол-ство не должно превышать 32 000.")
+        return list_id_amount
+
+    def resolve_tags(self, id_tags):
+        """ Тэги в порядке запроса, без повторов, одним запросом """
+        try:
+            id_tags = list(dict.fromkeys(int(pk) for pk in id_tags))
+        except (TypeError, ValueError):
+            raise ValidationError({"tags": "id тэга должен быть числом."})
+        tags_obj = Tag.objects.in_bulk(id_tags)
+        missing = [pk for pk in id_tags if pk not in tags_obj]
+        if missing:
+            raise ValidationError({"tags": (
+                "Нет тэгов с id: " + ", ".join(str(pk) for pk in missing)
+            )})
+        return [tags_obj[pk] for pk in id_tags]
+
+    def save(self, **kwargs):
+        # Картинку начнут обрабатывать после коммита, когда рецепт
+        # сохранен вместе с тегами и ингредиентами.
+        try:
+            with transaction.atomic():
+                return super().save(**kwargs)
+        finally:
+            # Временный файл уже перенесен в MEDIA_ROOT, закрываем его
+            image = self.validated_data.get("image")
+            if image is not None:
+                image.close()
 
     def create(self, validated_data):
         user = self.context["request"].user
         tags = validated_data.pop("tags")
         ingredients = validated_data.pop("ingredients")
 
-        new_recipe = Recipe.objects.create(author=user, **validated_data)
+        new_recipe = Recipe.objects.create(
+            author=user,
+            image_source_hash=validated_data["image"].sha256,
+            **validated_data
+        )
         make_new_count_ingr(CountIngredient, new_recipe, ingredients)
         new_recipe.tags.set(tags)
         return new_recipe
 
     def update(self, instance, validated_data):
-        instance.name = validated_data.get("name", instance.name)
-        instance.text = validated_data.get("text", instance.text)
-        instance.image = validated_data.get("image", instance.image)
-        instance.cooking_time = validated_data.get("cooking_time",
-                                                   instance.cooking_time)
-
-        instance.save()
+        """ Сохраняет только то, что действительно поменялось.
+
+            Та же картинка (по хэшу загруженных байтов) повторно не
+            сохраняется и не обрабатывается, тэги без изменений не
+            перезаписываются, ингредиенты обновляются по разнице.
+        """
+        changed = [
+            field for field in ("name", "text", "cooking_time")
+            if field in validated_data
+            and validated_data[field] != getattr(instance, field)
+        ]
+        for field in changed:
+            setattr(instance, field, validated_data[field])
+
+        image = validated_data.get("image")
+        if image is not None and image.sha256 != instance.image_source_hash:
+            instance.image = image
+            instance.image_source_hash = image.sha256
+            changed += ["image", "image_source_hash", "image_status",
+                        "image_hash", "image_variants"]
+        if changed:
+            instance.save(update_fields=changed)
 
         ingredients_data = validated_data.get("ingredients")
         if ingredients_data is not None:
-            instance.ingredients.clear()
-            make_new_count_ingr(CountIngredient, instance, ingredients_data)
+            update_count_ingr(CountIngredient, instance, ingredients_data)
 
         tags_data = validated_data.get("tags")
         if tags_data is not None:
-            instance.tags.set(tags_data)
+            current = {tag.id for tag in instance.tags.all()}
+            if current != {tag.id for tag in tags_data}:
+                instance.tags.set(tags_data)
 
         return instance
 
@@ -204,10 +320,14 @@ class ShortRecipeSerializer(ModelSerializer):
     Короткий вид рецептов для подписок на юзера.
 
     """
+    image_variants = SerializerMethodField()
 
     class Meta:
         model = Recipe
-        fields = "id", "name", "image", "cooking_time"
+        fields = "id", "name", "image", "image_variants", "cooking_time"
+
+    def get_image_variants(self, obj):
+        return get_image_variant_urls(obj, self.context.get("request"))
 
 
 class UserSubscribeSerializer(CustomUserSerializer):
@@ -220,17 +340,19 @@ class UserSubscribeSerializer(CustomUserSerializer):
         return True
 
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
     def get_recipes(self, obj):
         request = self.context["request"]
-        recipes_limit = request.query_params.get("recipes_limit")
-        recipes_auth = obj.recipes.all()
-
-        if recipes_limit is not None:
-            recipes_auth = recipes_auth[:int(recipes_limit)]
-            return ShortRecipeSerializer(recipes_auth, many=True).data
-        return ShortRecipeSerializer(many=True).data
+        if hasattr(obj, "preview_recipes"):
+            recipes_auth = obj.preview_recipes
+        else:
+            recipes_auth = obj.recipes.all()
+            recipes_limit = get_recipes_limit(request)
+            if recipes_limit is not None:
+                recipes_auth = recipes_auth[:recipes_limit]
+        return ShortRecipeSerializer(recipes_auth, many=True,
+                                     context={"request": request}).data
 
     def validate(self, data):
         request = self.context["request"]
@@ -264,9 +386,6 @@ class SubscribeSerializer(ModelSerializer):
     def validate(self, data):
         user = self.context["request"].user
         author = self.context["author"]
-        existing_sub = user.subscriptions.filter(author=author).first()
-        if existing_sub:
-            raise ValidationError("Вы уже подписаны на пользователя!")
         if author == user:
             raise ValidationError("Вы не можете подписаться на самого себя")
         return data
@@ -274,8 +393,11 @@ class SubscribeSerializer(ModelSerializer):
     def create(self, validated_data):
         user = validated_data["user"]
         author = validated_data["author"]
-        return Subscribe.objects.create(user=user,
-                                        author=author)
+        with transaction.atomic():
+            subscribe = insert_or_ignore(Subscribe, user=user, author=author)
+            if subscribe is None:
+                raise already_exists("Вы уже подписаны на пользователя!")
+        return subscribe
 
     def to_representation(self, obj):
         representation = super().to_representation(obj)
@@ -296,23 +418,26 @@ class FavoriteSerializer(ModelSerializer):
             "recipe": {"read_only": True},
         }
 
-    def validate(self, data):
-        user = self.context["request"].user
-        recipe = self.context["recipe"]
-
-        existing_fav = user.in_favorites.filter(recipe=recipe).first()
-
-        if existing_fav:
-            raise ValidationError("Вы уже добавили в избранное!")
-        return data
-
     def create(self, validated_data):
         user = validated_data["user"]
         recipe = validated_data["recipe"]
-        return Favorite.objects.create(user=user,
-                                       recipe=recipe)
+        with transaction.atomic():
+            favorite = insert_or_ignore(Favorite, user=user, recipe=recipe)
+            if favorite is None:
+                raise already_exists("Вы уже добавили в избранное!")
+        return favorite
 
     def to_representation(self, obj):
         return ShortRecipeSerializer(obj.recipe, context={
             "request": self.context["request"]
         }).data
+
+
+class RecipeIdsSerializer(Serializer):
+    """ Список id рецептов для пакетного добавления/удаления """
+
+    recipes = ListField(child=IntegerField(min_value=1), allow_empty=False,
+                        max_length=MAX_BATCH_RECIPES)
+
+    def validate_recipes(self, value):
+        return list(dict.fromkeys(value))
@@ -0,0 +1,85 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from api.authentication import AUTH_NAMESPACE
+from api.cache import RECIPES_NAMESPACE, TAGS_NAMESPACE, bump_stamp
+from api.core import change_counter
+from api.search import invalidate_ingredient_index
+from recipes.models import Cart, Favorite, Ingredient, Recipe, Tag
+from users.models import Subscribe
+
+User = get_user_model()
+
+# Поля пользователя, которые видны на карточке рецепта
+RECIPE_CARD_FIELDS = ("email", "username", "first_name", "last_name")
+AUTH_FIELDS = ("password", "is_active")
+
+# строка -> (у кого счетчик, поле счетчика, ссылка на владельца)
+COUNTERS = {
+    Favorite: (Recipe, "favorites_count", "recipe_id"),
+    Cart: (Recipe, "in_carts_count", "recipe_id"),
+    Subscribe: (User, "subscribers_count", "author_id"),
+    Recipe: (User, "recipes_count", "author_id"),
+}
+
+
+def counted_row_created(sender, instance, created, raw=False, **kwargs):
+    # loaddata приносит счетчики вместе с данными
+    if created and not raw:
+        model, field, link = COUNTERS[sender]
+        change_counter(model, field, 1, pk=getattr(instance, link))
+
+
+def counted_row_deleted(sender, instance, **kwargs):
+    """ Срабатывает и на каскадное удаление, и на queryset.delete() """
+    model, field, link = COUNTERS[sender]
+    change_counter(model, field, -1, pk=getattr(instance, link))
+
+
+for counted in COUNTERS:
+    post_save.connect(counted_row_created, sender=counted)
+    post_delete.connect(counted_row_deleted, sender=counted)
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredient_changed(**kwargs):
+    transaction.on_commit(invalidate_ingredient_index)
+    transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tag_changed(**kwargs):
+    transaction.on_commit(lambda: bump_stamp(TAGS_NAMESPACE))
+    transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def recipe_changed(**kwargs):
+    transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(**kwargs):
+    transaction.on_commit(lambda: bump_stamp(AUTH_NAMESPACE))
+
+
+@receiver(post_save, sender=User)
+def user_saved(instance, created, update_fields=None, **kwargs):
+    # Новый пользователь еще не встречается ни в токенах, ни в рецептах.
+    # Вход djoser сохраняет только last_login и сюда тоже не доходит.
+    if created:
+        return
+    if instance.changed_fields(AUTH_FIELDS, update_fields):
+        transaction.on_commit(lambda: bump_stamp(AUTH_NAMESPACE))
+    if instance.changed_fields(RECIPE_CARD_FIELDS, update_fields):
+        transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(**kwargs):
+    transaction.on_commit(lambda: bump_stamp(AUTH_NAMESPACE))
+    # Рецепты удаленного автора теряют его через UPDATE без сигналов
+    transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
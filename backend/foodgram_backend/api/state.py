@@ -0,0 +1,91 @@
+from django.core.cache import cache
+from django.db import transaction
+
+from api.cache import bump_stamp, get_stamp
+from recipes.models import Cart, Favorite
+from users.models import Subscribe
+
+USER_STATE_TIMEOUT = 10 * 60
+FAVORITES = "favorites"
+CART = "cart"
+FOLLOWING = "following"
+USER_STATE_QUERIES = {
+    FAVORITES: (Favorite, "recipe_id"),
+    CART: (Cart, "recipe_id"),
+    FOLLOWING: (Subscribe, "author_id"),
+}
+
+
+def user_state_namespace(user_id, kind):
+    return f"user:{user_id}:{kind}"
+
+
+def user_state_key(user_id, kind):
+    """ Ключ множества содержит его версию: множество, прочитанное
+        из базы до сброса, запишется под старым ключом и читаться
+        уже не будет.
+    """
+    version, _ = get_stamp(user_state_namespace(user_id, kind))
+    return f"{user_state_namespace(user_id, kind)}:{version}"
+
+
+def invalidate_user_state(user_id, *kinds):
+    """ Меняет версию множеств пользователя после коммита.
+
+        Вызывается эндпоинтами избранного, корзины и подписок.
+        Изменения через админку видны после USER_STATE_TIMEOUT.
+    """
+    def bump():
+        for kind in kinds:
+            bump_stamp(user_state_namespace(user_id, kind))
+    transaction.on_commit(bump)
+
+
+class UserState:
+    """ Избранное, корзина и подписки пользователя множествами id.
+
+        Каждое множество читается из кэша (или одним запросом из базы)
+        при первом обращении и дальше проверяется за O(1), поэтому
+        флаги в ответе не зависят от SQL-запроса страницы.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.loaded = {}
+
+    def ids(self, kind):
+        if kind not in self.loaded:
+            self.loaded[kind] = self.load(kind)
+        return self.loaded[kind]
+
+    def load(self, kind):
+        if self.user.is_anonymous:
+            return frozenset()
+        # Версия берется до чтения из базы, см. user_state_key
+        key = user_state_key(self.user.pk, kind)
+        ids = cache.get(key)
+        if ids is None:
+            model, field = USER_STATE_QUERIES[kind]
+            # Meta.ordering у Cart добавил бы JOIN с рецептами
+            ids = frozenset(model.objects.filter(user=self.user)
+                            .order_by().values_list(field, flat=True))
+            cache.set(key, ids, USER_STATE_TIMEOUT)
+        return ids
+
+    def is_favorited(self, recipe_id):
+        return recipe_id in self.ids(FAVORITES)
+
+    def is_in_shopping_cart(self, recipe_id):
+        return recipe_id in self.ids(CART)
+
+    def is_subscribed(self, author_id):
+        return author_id in self.ids(FOLLOWING)
+
+
+def get_user_state(request):
+    """ Один UserState на запрос, общий для всех сериализаторов """
+    state = getattr(request, "user_state", None)
+    if state is None or state.user != request.user:
+        state = UserState(request.user)
+        request.user_state = state
+    return state
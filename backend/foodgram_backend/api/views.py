@@ -1,11 +1,15 @@
-from collections import defaultdict
-
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
-from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
+from django.db.models import (Exists, F, FilteredRelation, OuterRef,
+                              Prefetch, Q, Sum)
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth import get_user_model
 from rest_framework.status import (HTTP_400_BAD_REQUEST,
                                    HTTP_204_NO_CONTENT,
@@ -13,26 +17,53 @@ from rest_framework.status import (HTTP_400_BAD_REQUEST,
 from djoser.views import UserViewSet as DjUserViewSet
 
 from users.models import CustomUser, Subscribe
-from api.paginators import CustomPagination, RecipePagination
+from api.core import (INGREDIENT_SEARCH_LIMIT, INGREDIENT_SEARCH_MAX_LIMIT,
+                      bulk_insert_or_ignore, insert_or_ignore)
+from api.paginators import (COUNT_CACHE_TIMEOUT, CustomPagination,
+                            KeysetPagination)
 from api.permissions import OwnerUserOrReadOnly
 from recipes.models import (Tag,
                             Ingredient,
                             CountIngredient,
-                            Recipe,)
+                            Cart,
+                            Favorite,
+                            Recipe,
+                            RecipeRanking,)
 from api.serializers import (FavoriteSerializer, ShortRecipeSerializer,
                              TagSerializer,
                              IngredientSerializer,
                              RecipeSerializer,
+                             RecipeIdsSerializer,
                              SubscribeSerializer,
-                             UserSubscribeSerializer)
+                             UserSubscribeSerializer,
+                             get_recipes_limit)
+from api.cache import (RECIPES_NAMESPACE, TAGS_NAMESPACE, CachedPageMixin,
+                       CachedResponseMixin, bump_stamp)
+from api.state import (CART, FAVORITES, FOLLOWING, get_user_state,
+                       invalidate_user_state)
+from api.search import (INGREDIENTS_NAMESPACE, in_memory_search,
+                        search_ingredients, use_in_memory_index)
+from api.renderers import (ShoppingCartCSVRenderer,
+                           ShoppingCartNegotiation,
+                           ShoppingCartPDFRenderer,
+                           ShoppingCartTextRenderer)
 from api.permissions import (AdminOrReadOnly,
                              AuthorStaffOrReadOnly)
 
 User = get_user_model()
 
+SHOPPING_CART_CHUNK_SIZE = 500
+BATCH_ADDED = "added"
+BATCH_EXISTS = "exists"
+BATCH_NOT_FOUND = "not_found"
+BATCH_REMOVED = "removed"
+BATCH_ABSENT = "absent"
+RecipeTag = Recipe.tags.through
+
 
 class CustomUserViewSet(DjUserViewSet):
     pagination_class = CustomPagination
+    keyset_ordering = ("last_name", "first_name", "id")
     add_serializer = UserSubscribeSerializer
     link_model = Subscribe
 
@@ -56,57 +87,127 @@ class CustomUserViewSet(DjUserViewSet):
                                                             "author": author})
         subscribe_serializer.is_valid(raise_exception=True)
         subscribe_serializer.save(user=request.user, author=author)
+        invalidate_user_state(request.user.pk, FOLLOWING)
         return Response(subscribe_serializer.data, status=HTTP_201_CREATED)
 
     @subscribe.mapping.delete
     def delete_subscribe(self, request, id):
-        author = get_object_or_404(CustomUser, id=id)
-
-        subscription = author.subscribers.filter(user=request.user).first()
-        if subscription is None:
+        deleted, _ = Subscribe.objects.filter(user=request.user,
+                                              author=id).delete()
+        if not deleted:
+            get_object_or_404(CustomUser, id=id)
             return Response({"error": "Вы уже отписались!"},
                             status=HTTP_400_BAD_REQUEST)
-        subscription.delete()
+        invalidate_user_state(request.user.pk, FOLLOWING)
         return Response(status=HTTP_204_NO_CONTENT)
 
-    @action(methods=("get",), detail=False, pagination_class=RecipePagination)
+    @action(methods=("get",), detail=False)
     def subscriptions(self, request):
-        pages = self.paginate_queryset(
-            User.objects.filter(subscribers__user=self.request.user)
+        """
+            Страница авторов стоит одинаковое число запросов при любом
+            числе подписок: recipes_count хранится в самом авторе, а
+            первые recipes_limit рецептов всех авторов страницы
+            достаются одним запросом с оконной функцией.
+
+        """
+        recipes = Recipe.objects.all()
+        recipes_limit = get_recipes_limit(request)
+        if recipes_limit is not None:
+            recipes = recipes[:recipes_limit]
+        authors = (
+            User.objects
+            .filter(subscribers__user=self.request.user)
+            .order_by("last_name", "first_name", "id")
+            .prefetch_related(Prefetch("recipes", queryset=recipes,
+                                       to_attr="preview_recipes"))
+        )
+        pages = self.paginate_queryset(authors)
+        # Без ?limit= CustomPagination не делит выдачу на страницы
+        serializer = UserSubscribeSerializer(
+            authors if pages is None else pages, many=True,
+            context={"request": request}
         )
-        serializer = UserSubscribeSerializer(pages, many=True,
-                                             context={"request": request})
+        if pages is None:
+            return Response(serializer.data)
         return self.get_paginated_response(serializer.data)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(CachedResponseMixin, ReadOnlyModelViewSet):
+    cache_namespace = TAGS_NAMESPACE
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
     permission_classes = (AdminOrReadOnly,)
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(CachedResponseMixin, ReadOnlyModelViewSet):
+    cache_namespace = INGREDIENTS_NAMESPACE
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
     permission_classes = (AdminOrReadOnly,)
 
     def get_queryset(self):
-        query = self.request.query_params.get("name", " ").strip().lower()
-        return Ingredient.objects.filter(
-            Q(name__startswith=query) | Q(name__icontains=query)
-        )
-
+        """
+            Без ?name= отдается весь справочник, с ним - поиск, где
+            совпадения по началу названия идут выше, чем по подстроке.
+            Число результатов ограничивается ?limit=.
 
-class RecipeViewSet(ModelViewSet):
+        """
+        query = self.request.query_params.get("name", "").strip()
+        if self.action != "list":
+            return super().get_queryset()
+        if not query:
+            if use_in_memory_index():
+                return in_memory_search.all()
+            return super().get_queryset()
+        return search_ingredients(query, self.get_limit())
+
+    def get_object(self):
+        if not use_in_memory_index():
+            return super().get_object()
+        try:
+            ingredient = in_memory_search.get(int(self.kwargs["pk"]))
+        except ValueError:
+            ingredient = None
+        if ingredient is None:
+            raise Http404
+        self.check_object_permissions(self.request, ingredient)
+        return ingredient
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params.get(
+                "limit", INGREDIENT_SEARCH_LIMIT))
+        except ValueError:
+            return INGREDIENT_SEARCH_LIMIT
+        return min(max(limit, 1), INGREDIENT_SEARCH_MAX_LIMIT)
+
+
+class RecipeViewSet(CachedPageMixin, ModelViewSet):
     queryset = Recipe.objects.all()
+    cache_namespace = RECIPES_NAMESPACE
+    page_cache_params = ("tags", "author", "ordering", "page", "limit")
+    multi_value_params = ("tags",)
     permission_classes = (AuthorStaffOrReadOnly,)
     serializer_class = RecipeSerializer
     pagination_class = CustomPagination
+    keyset_ordering = ("-pub_date", "-id")
+    count_cache_timeout = COUNT_CACHE_TIMEOUT
     add_serializer = ShortRecipeSerializer
+    # Картинку можно прислать base64 в JSON или файлом в multipart-форме
+    parser_classes = (JSONParser, MultiPartParser, FormParser)
 
     def get_queryset(self):
+        """
+            Фильтр по тэгам - подзапрос EXISTS: в отличие от JOIN он не
+            размножает строки рецептов, и DISTINCT по всем колонкам
+            (включая text) не нужен. Избранное и корзина одного
+            пользователя невелики, поэтому там pk IN (подзапрос):
+            база сначала берет id из индекса по user, а не проверяет
+            каждый рецепт по порядку pub_date.
+
+        """
         queryset = super().get_queryset()
         user = self.request.user
         query_params = self.request.query_params
@@ -118,15 +219,116 @@ class RecipeViewSet(ModelViewSet):
         if author:
             queryset = queryset.filter(author=author)
 
+        if (carts == "1" or is_favorited == "1") and user.is_anonymous:
+            return queryset.none()
+
         if carts == "1":
-            queryset = queryset.filter(in_carts__user=user)
+            queryset = queryset.filter(
+                pk__in=Cart.objects.filter(user=user).values("recipe"))
 
         if is_favorited == "1":
-            queryset = queryset.filter(is_favorited__user=user)
+            queryset = queryset.filter(
+                pk__in=Favorite.objects.filter(user=user).values("recipe"))
 
         if tags:
-            return queryset.filter(tags__slug__in=tags).distinct()
-        return queryset
+            queryset = queryset.filter(Exists(RecipeTag.objects.filter(
+                recipe=OuterRef("pk"), tag__slug__in=tags)))
+
+        ordering = query_params.get("ordering")
+        if ordering in dict(RecipeRanking.KINDS):
+            queryset = self.order_by_ranking(queryset, ordering)
+        return self.with_related(queryset)
+
+    def order_by_ranking(self, queryset, kind):
+        """
+            ?ordering=popular|trending: место берется из заранее
+            посчитанной таблицы RecipeRanking (manage.py
+            compute_rankings). Рецепты без места идут следом по дате.
+            Курсор листает только по keyset_ordering, поэтому вместе
+            с ?ordering= он не принимается.
+
+        """
+        if CustomPagination.cursor_query_param in self.request.query_params:
+            raise ValidationError({
+                CustomPagination.cursor_query_param: [
+                    "Курсор нельзя совмещать с ?ordering=, "
+                    "используйте ?page=."
+                ]
+            })
+        return queryset.annotate(ranking=FilteredRelation(
+            "rankings", condition=Q(rankings__kind=kind)
+        )).order_by(F("ranking__position").asc(nulls_last=True),
+                    "-pub_date", "-id")
+
+    def with_related(self, queryset):
+        """
+            План запроса для RecipeSerializer: автор, тэги и ингредиенты
+            подтягиваются пачкой. Флаги избранного, корзины и подписки
+            берутся из UserState, поэтому запрос одинаков для всех
+            пользователей.
+
+        """
+        return queryset.select_related("author").prefetch_related(
+            "tags",
+            Prefetch("amount",
+                     queryset=CountIngredient.objects.select_related(
+                         "ingredient")),
+        )
+
+    def perform_create(self, serializer):
+        serializer.save()
+        self.reload(serializer)
+
+    def perform_update(self, serializer):
+        serializer.save()
+        # Ингредиенты обновляются bulk-операциями без сигналов
+        transaction.on_commit(lambda: bump_stamp(RECIPES_NAMESPACE))
+        self.reload(serializer)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Ошибки при скачивании списка покупок - JSON, а не файл
+        if (self.action == "download_shopping_cart"
+                and getattr(response, "exception", False)):
+            request.accepted_renderer = JSONRenderer()
+            request.accepted_media_type = JSONRenderer.media_type
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def overlay_cached_page(self, data):
+        """ Флаги текущего пользователя поверх общей страницы """
+        state = get_user_state(self.request)
+        # Без ?limit= выдача не разбита на страницы и приходит списком
+        recipes = data["results"] if isinstance(data, dict) else data
+        for recipe in recipes:
+            recipe["is_favorited"] = state.is_favorited(recipe["id"])
+            recipe["is_in_shopping_cart"] = state.is_in_shopping_cart(
+                recipe["id"])
+            author = recipe["author"]
+            author["is_subscribed"] = state.is_subscribed(author["id"])
+
+    def reload(self, serializer):
+        """ Ответ после записи строится по тому же плану запросов,
+            что и чтение, а не по строке ингредиента на запрос.
+        """
+        serializer.instance = self.with_related(
+            Recipe.objects.filter(pk=serializer.instance.pk)
+        ).get()
+
+    @action(detail=False, methods=("get",),
+            permission_classes=(IsAuthenticated,),
+            pagination_class=KeysetPagination)
+    def feed(self, request):
+        """
+            Свежие рецепты авторов, на которых подписан пользователь.
+            Листается курсором ?cursor= по (pub_date, id), поэтому
+            глубокие страницы не медленнее первой.
+
+        """
+        queryset = self.with_related(
+            Recipe.objects.filter(author__subscribers__user=request.user)
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=True)
     def favorite(self, request, pk):
@@ -148,20 +350,92 @@ class RecipeViewSet(ModelViewSet):
         favorite_serializer.is_valid(raise_exception=True)
         favorite_serializer.save(user=request.user,
                                  recipe=recipe)
+        invalidate_user_state(request.user.pk, FAVORITES)
         return Response(favorite_serializer.data,
                         status=HTTP_201_CREATED)
 
     @favorite.mapping.delete
     def delete_favorite(self, request, pk):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        is_favorite = recipe.is_favorited.filter(user=request.user).first()
-        if is_favorite is None:
+        deleted, _ = Favorite.objects.filter(user=request.user,
+                                             recipe=pk).delete()
+        if not deleted:
+            get_object_or_404(Recipe, pk=pk)
             return Response({"errors":
                             "Рецепт и так не является фаворитом!"},
                             status=HTTP_400_BAD_REQUEST)
-        is_favorite.delete()
+        invalidate_user_state(request.user.pk, FAVORITES)
         return Response(status=HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=("post", "delete"),
+            url_path="favorite/batch", url_name="favorite-batch",
+            permission_classes=(IsAuthenticated,))
+    def favorite_batch(self, request):
+        """
+            Добавляет (POST) или убирает (DELETE) сразу несколько
+            рецептов из избранного: {"recipes": [1, 2, 3]}.
+
+        """
+        return self.batch_response(Favorite, FAVORITES, request)
+
+    @action(detail=False, methods=("post", "delete"),
+            url_path="shopping_cart/batch", url_name="shopping-cart-batch",
+            permission_classes=(IsAuthenticated,))
+    def shopping_cart_batch(self, request):
+        """
+            То же, что favorite_batch, но для списка покупок:
+            неделя меню добавляется одним запросом.
+
+        """
+        return self.batch_response(Cart, CART, request)
+
+    def batch_response(self, model, state_kind, request):
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["recipes"]
+        with transaction.atomic():
+            if request.method == "POST":
+                statuses = self.batch_add(model, request.user, ids)
+            else:
+                statuses = self.batch_remove(model, request.user, ids)
+            invalidate_user_state(request.user.pk, state_kind)
+        return Response({"results": [{"id": recipe, "status": statuses[recipe]}
+                                     for recipe in ids]})
+
+    def batch_add(self, model, user, ids):
+        """ Один INSERT на все новые рецепты, уже добавленные пропускаются.
+            Счетчики и статусы считаются по строкам, которые вставил
+            именно этот запрос (RETURNING), а не по чтению до вставки.
+        """
+        found = set(Recipe.objects.filter(id__in=ids)
+                    .values_list("id", flat=True))
+        existing = set(model.objects.filter(user=user, recipe__in=found)
+                       .values_list("recipe", flat=True))
+        added = bulk_insert_or_ignore(
+            model, [model(user=user, recipe_id=recipe)
+                    for recipe in found - existing],
+            returning="recipe",
+        )
+        if added is None:
+            added = found - existing
+        return {recipe: (BATCH_NOT_FOUND if recipe not in found
+                         else BATCH_ADDED if recipe in added
+                         else BATCH_EXISTS)
+                for recipe in ids}
+
+    def batch_remove(self, model, user, ids):
+        """ Один DELETE на все рецепты, которые были в списке.
+            Строки блокируются до удаления, поэтому параллельный запрос
+            их уже не увидит и не вычтет из счетчика второй раз.
+        """
+        queryset = model.objects.filter(user=user, recipe__in=ids)
+        removed = set(queryset.order_by().select_for_update()
+                      .values_list("recipe", flat=True))
+        if removed:
+            queryset.filter(recipe__in=removed).delete()
+        return {recipe: (BATCH_REMOVED if recipe in removed
+                         else BATCH_ABSENT)
+                for recipe in ids}
+
     @action(detail=True)
     def shopping_cart(self, request, pk):
         """
@@ -174,53 +448,62 @@ class RecipeViewSet(ModelViewSet):
     @shopping_cart.mapping.post
     def create_shopping_cart(self, request, pk):
         recipe = get_object_or_404(Recipe, pk=pk)
-        existing_cart = request.user.in_carts.filter(recipe=recipe).first()
-        if existing_cart:
+        with transaction.atomic():
+            cart = insert_or_ignore(Cart, user=request.user, recipe=recipe)
+        if cart is None:
             return Response({"errors":
                              "Вы уже добавили этот рецепт в список покупок"},
                             status=HTTP_400_BAD_REQUEST)
-
-        link_cart = recipe.in_carts.create(user=request.user)
-        link_cart.save()
+        invalidate_user_state(request.user.pk, CART)
         serializer = self.add_serializer(recipe)
         return Response(serializer.data, status=HTTP_201_CREATED)
 
     @shopping_cart.mapping.delete
     def delete_shopping_cart(self, request, pk):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        cart = recipe.in_carts.filter(user=request.user).first()
-        if cart is None:
+        deleted, _ = Cart.objects.filter(user=request.user,
+                                         recipe=pk).delete()
+        if not deleted:
+            get_object_or_404(Recipe, pk=pk)
             return Response({"errors":
                              "Рецепт и так не добавлен в список покупок!"},
                             status=HTTP_400_BAD_REQUEST)
-        cart.delete()
+        invalidate_user_state(request.user.pk, CART)
         return Response(status=HTTP_204_NO_CONTENT)
 
-    @action(detail=False, methods=("get",))
+    @action(detail=False, methods=("get",),
+            permission_classes=(IsAuthenticated,),
+            renderer_classes=(ShoppingCartTextRenderer,
+                              ShoppingCartCSVRenderer,
+                              ShoppingCartPDFRenderer),
+            content_negotiation_class=ShoppingCartNegotiation)
     def download_shopping_cart(self, request):
-        user = self.request.user
-        recipes = Recipe.objects.filter(in_carts__user=request.user)
-
-        ingredients_list = defaultdict(int)
-
-        for recipe in recipes:
-            ingredients = recipe.ingredients.all()
-
-            for ingredient in ingredients:
-                amount = CountIngredient.objects.get(
-                    recipe=recipe,
-                    ingredient=ingredient).amount
-
-                ingredients_list[str(ingredient)] += amount
+        """
+            Собирает список покупок одним агрегирующим запросом:
+            суммирует количество по ингредиенту и единице измерения.
+            Формат выбирается через ?format=txt|csv|pdf. Строки
+            читаются курсором; txt и csv сразу отдаются клиенту,
+            PDF - после того, как собран во временном файле.
 
-        response = HttpResponse(
-            "\n".join(
-                [f"{ingredient} - {amount}"
-                 for ingredient, amount in ingredients_list.items()]
-            ), content_type="text/plain"
+        """
+        user = self.request.user
+        renderer = request.accepted_renderer
+        ingredients_list = (
+            CountIngredient.objects
+            .filter(recipe__in_carts__user=user)
+            .values_list("ingredient__name", "ingredient__measurement_unit")
+            .annotate(total=Sum("amount"))
+            .order_by("ingredient__name", "ingredient__measurement_unit")
+            .iterator(chunk_size=SHOPPING_CART_CHUNK_SIZE)
         )
 
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f"{content_type}; charset={renderer.charset}"
+        response = StreamingHttpResponse(renderer.stream(ingredients_list),
+                                         content_type=content_type)
+
         response["Content-Disposition"] = (
-            f"attachment; filename={str(user)}_shopping_cart.txt")
+            "attachment; "
+            f"filename={str(user)}_shopping_cart.{renderer.format}")
 
         return response
@@ -120,12 +120,15 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ]
 }
 DJOSER = {
     "LOGIN_FIELD": "email",
     "HIDE_USERS": False,
+    # Ссылки из писем сброса пароля и логина ведут на фронтенд
+    "PASSWORD_RESET_CONFIRM_URL": "password/reset/confirm/{uid}/{token}",
+    "USERNAME_RESET_CONFIRM_URL": "username/reset/confirm/{uid}/{token}",
     "PERMISSIONS": {
         "resipe": ("api.permissions.AuthorStaffOrReadOnly,",),
         "recipe_list": ("api.permissions.AuthorStaffOrReadOnly",),
@@ -139,3 +142,49 @@ DJOSER = {
         "user_create": "api.serializers.CustomUserSerializer",
     },
 }
+
+SHOPPING_CART_PDF_FONT = os.getenv(
+    'SHOPPING_CART_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
+# Индекс ингредиентов в памяти процесса для автодополнения.
+# INGREDIENT_INDEX_ENABLED=False действует только на PostgreSQL: там
+# поиск идет по индексам БД. На SQLite и других базах индекс
+# используется всегда, потому что они не сворачивают регистр кириллицы.
+INGREDIENT_INDEX_ENABLED = os.getenv(
+    'INGREDIENT_INDEX_ENABLED', 'True'
+).lower() in ('true', '1', 'yes')
+INGREDIENT_INDEX_WARM_ON_START = os.getenv(
+    'INGREDIENT_INDEX_WARM_ON_START', 'False'
+).lower() in ('true', '1', 'yes')
+
+# Для нескольких воркеров нужен общий кэш, например
+# django.core.cache.backends.db.DatabaseCache (python manage.py
+# createcachetable) или FileBasedCache: через него процессы узнают
+# об изменении справочников.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'foodgram'),
+    },
+    # Готовые страницы списка рецептов: память, файлы
+    # (FileBasedCache) или база (DatabaseCache, createcachetable)
+    'pages': {
+        'BACKEND': os.getenv(
+            'PAGE_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('PAGE_CACHE_LOCATION', 'foodgram-pages'),
+    },
+}
+
+# Обработка картинок рецептов: "thread" - пул потоков в процессе
+# веб-сервера, "database" - очередь в БД, которую разбирает
+# python manage.py process_images --watch. С "thread" задачи, потерянные
+# при перезапуске процесса, подбирает только process_images.
+IMAGE_PROCESSING_BROKER = os.getenv('IMAGE_PROCESSING_BROKER', 'thread')
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', 2))
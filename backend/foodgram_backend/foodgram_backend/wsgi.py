@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
+from django.core.management import call_command
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram_backend.settings')
 
 application = get_wsgi_application()
+
+if settings.INGREDIENT_INDEX_WARM_ON_START:
+    call_command('warm_ingredient_index')
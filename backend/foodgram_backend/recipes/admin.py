@@ -6,7 +6,8 @@ from .models import (
     Ingredient,
     Favorite,
     CountIngredient,
-    Cart
+    Cart,
+    RecipeRanking
 )
 
 
@@ -18,6 +19,10 @@ class RecipeIngredientInline(admin.TabularInline):
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
     inlines = [RecipeIngredientInline]
+    list_display = ('name', 'author', 'image_status',
+                    'favorites_count', 'in_carts_count')
+    readonly_fields = ('favorites_count', 'in_carts_count')
+    list_filter = ('image_status',)
 
 
 @admin.register(Tag)
@@ -43,3 +48,9 @@ class CartAdmin(admin.ModelAdmin):
 @admin.register(CountIngredient)
 class CountIngredientAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(RecipeRanking)
+class RecipeRankingAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'position', 'recipe', 'score', 'computed_at')
+    list_filter = ('kind',)
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+def create_search_indexes(apps, schema_editor):
+    """ Индексы для поиска ингредиентов есть только на PostgreSQL:
+        на SQLite поиск идет по индексу в памяти процесса.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_prefix_idx '
+        'ON recipes_ingredient (lower(name) text_pattern_ops)'
+    )
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_trgm_idx '
+        'ON recipes_ingredient USING gin (lower(name) gin_trgm_ops)'
+    )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS recipes_ingredient_name_prefix_idx'
+    )
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS recipes_ingredient_name_trgm_idx'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_alter_countingredient_recipe_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
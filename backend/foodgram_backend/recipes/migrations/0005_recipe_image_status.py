@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:13
+
+from django.db import migrations, models
+
+
+def mark_existing_images_done(apps, schema_editor):
+    """ Старые картинки уже уменьшены синхронно в Recipe.save """
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Recipe.objects.update(image_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_ingredient_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='SHA-256 обработанной картинки'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('done', 'Готова'), ('failed', 'Ошибка')], default='pending', editable=False, max_length=16, verbose_name='Статус обработки картинки'),
+        ),
+        migrations.RunPython(mark_existing_images_done,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_pub_date_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['user', 'recipe'], name='cart_user_recipe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['user', 'recipe'], name='favorite_user_recipe_idx'),
+        ),
+        # Фильтр по тэгам идет от тэга к рецептам, а уникальный индекс
+        # таблицы связи начинается с recipe_id.
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS recipes_recipe_tags_tag_recipe_idx '
+            'ON recipes_recipe_tags (tag_id, recipe_id)',
+            'DROP INDEX IF EXISTS recipes_recipe_tags_tag_recipe_idx',
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:27
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """ До уникального индекса дубли оставались при двойном клике """
+    for model_name in ('Favorite', 'Cart'):
+        model = apps.get_model('recipes', model_name)
+        duplicates = (
+            model.objects.values('user', 'recipe')
+            .annotate(keep=Min('id'), total=Count('id'))
+            .filter(total__gt=1)
+        )
+        for row in duplicates:
+            model.objects.filter(
+                user=row['user'], recipe=row['recipe']
+            ).exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_filter_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='cart',
+            name='cart_user_recipe_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='favorite',
+            name='favorite_user_recipe_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='favorite',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_favorite'),
+        ),
+    ]
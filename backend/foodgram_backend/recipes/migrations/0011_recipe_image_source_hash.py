@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_favorite_cart_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_source_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='SHA-256 загруженной картинки'),
+        ),
+    ]
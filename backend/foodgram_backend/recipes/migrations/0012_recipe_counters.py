@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    for field, model_name in (('favorites_count', 'Favorite'),
+                              ('in_carts_count', 'Cart')):
+        model = apps.get_model('recipes', model_name)
+        total = (model.objects.filter(recipe=OuterRef('pk'))
+                 .order_by().values('recipe')
+                 .annotate(total=Count('id')).values('total'))
+        Recipe.objects.update(**{field: Coalesce(Subquery(total), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipe_image_source_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В списках покупок'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
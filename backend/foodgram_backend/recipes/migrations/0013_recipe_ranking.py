@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('popular', 'Популярные'), ('trending', 'Набирают популярность')], max_length=16, verbose_name='Рейтинг')),
+                ('position', models.PositiveIntegerField(verbose_name='Место')),
+                ('score', models.PositiveIntegerField(verbose_name='Очки')),
+                ('computed_at', models.DateTimeField(verbose_name='Дата и время расчета')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='recipes.recipe', verbose_name='Рецепт')),
+            ],
+            options={
+                'verbose_name': 'Рейтинг рецепта',
+                'verbose_name_plural': 'Рейтинги рецептов',
+                'ordering': ['kind', 'position'],
+                'indexes': [models.Index(fields=['kind', 'position'], name='recipe_ranking_position_idx')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'recipe'), name='unique_recipe_ranking')],
+            },
+        ),
+    ]
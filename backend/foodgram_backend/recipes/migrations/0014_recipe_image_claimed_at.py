@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_recipe_ranking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Обработка картинки начата'),
+        ),
+    ]
@@ -1,11 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from PIL import Image
 
 from api.core import (DEFAULT_INGR,
-                      MAX_SIZE_IMAGE,
                       MAX_TIME_COOK,
                       MIN_TIME_COOK,
                       MIN_COUNT_INGR,
@@ -14,7 +12,8 @@ from api.core import (DEFAULT_INGR,
                       MAX_LENGTH_NAME_INGR,
                       MAX_LENGTH_NAME_TAG,
                       MAX_LENGTH_MEASUR_UNIT,
-                      MAX_LENGTH_NAME_COLOR)
+                      MAX_LENGTH_NAME_COLOR,
+                      exclude_counter_fields)
 
 User = get_user_model()
 
@@ -37,7 +36,6 @@ class Tag(models.Model):
         ('слаг'),
         max_length=64,
         unique=True,
-        db_index=False
     )
 
     class Meta:
@@ -78,6 +76,19 @@ class Ingredient(models.Model):
 class Recipe(models.Model):
     """ Рецепты """
 
+    COUNTER_FIELDS = ('favorites_count', 'in_carts_count')
+
+    IMAGE_PENDING = 'pending'
+    IMAGE_PROCESSING = 'processing'
+    IMAGE_DONE = 'done'
+    IMAGE_FAILED = 'failed'
+    IMAGE_STATUSES = (
+        (IMAGE_PENDING, 'В очереди'),
+        (IMAGE_PROCESSING, 'Обрабатывается'),
+        (IMAGE_DONE, 'Готова'),
+        (IMAGE_FAILED, 'Ошибка'),
+    )
+
     name = models.CharField(
         verbose_name=('Название рецепта'),
         max_length=MAX_LENGTH_NAME_RECIPE)
@@ -111,9 +122,50 @@ class Recipe(models.Model):
         verbose_name=('Картинка'),
         upload_to='recipe_img/',)
 
+    image_status = models.CharField(
+        verbose_name=('Статус обработки картинки'),
+        max_length=16,
+        choices=IMAGE_STATUSES,
+        default=IMAGE_PENDING,
+        editable=False)
+
+    image_claimed_at = models.DateTimeField(
+        verbose_name=('Обработка картинки начата'),
+        null=True,
+        blank=True,
+        editable=False)
+
+    image_hash = models.CharField(
+        verbose_name=('SHA-256 обработанной картинки'),
+        max_length=64,
+        blank=True,
+        editable=False)
+
+    image_source_hash = models.CharField(
+        verbose_name=('SHA-256 загруженной картинки'),
+        max_length=64,
+        blank=True,
+        editable=False)
+
+    image_variants = models.JSONField(
+        verbose_name=('Уменьшенные копии картинки'),
+        default=dict,
+        blank=True,
+        editable=False)
+
     text = models.TextField(
         verbose_name=('Текст'),)
 
+    favorites_count = models.PositiveIntegerField(
+        verbose_name=('В избранном'),
+        default=0,
+        editable=False)
+
+    in_carts_count = models.PositiveIntegerField(
+        verbose_name=('В списках покупок'),
+        default=0,
+        editable=False)
+
     cooking_time = models.PositiveSmallIntegerField(
         verbose_name=('Время приготовления'),
         default=DEFAULT_INGR,
@@ -133,15 +185,42 @@ class Recipe(models.Model):
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ["-pub_date"]
+        indexes = (
+            models.Index(fields=('-pub_date', '-id'),
+                         name='recipe_pub_date_idx'),
+            # Лента подписок: рецепты авторов по дате публикации
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='recipe_author_pub_date_idx'),
+        )
 
     def __str__(self):
         return self.name
 
+    _loaded_image = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image = dict(zip(field_names, values)).get('image')
+        return instance
+
     def save(self, *args, **kwargs) -> None:
+        """ Картинка обрабатывается в фоне и только если файл сменился """
+        from recipes.tasks import enqueue_image_processing
+
+        image_changed = self.image.name != self._loaded_image
+        if image_changed:
+            self.image_status = self.IMAGE_PENDING
+            self.image_hash = ''
+            self.image_variants = {}
+        kwargs['update_fields'] = exclude_counter_fields(
+            self, self.COUNTER_FIELDS, kwargs.get('update_fields'))
         super().save(*args, **kwargs)
-        image = Image.open(self.image.path)
-        image.thumbnail(MAX_SIZE_IMAGE)
-        image.save(self.image.path)
+        self._loaded_image = self.image.name
+        if image_changed:
+            transaction.on_commit(
+                lambda: enqueue_image_processing(self.pk)
+            )
 
 
 class CountIngredient(models.Model):
@@ -202,6 +281,10 @@ class Favorite(models.Model):
     class Meta:
         verbose_name = "Избранный рецепт"
         verbose_name_plural = "Избранные рецепты"
+        constraints = (
+            models.UniqueConstraint(fields=("user", "recipe"),
+                                    name="unique_favorite"),
+        )
 
     def __str__(self) -> str:
         return f"{self.user} добавил в фавориты рецепт {self.recipe}"
@@ -231,6 +314,57 @@ class Cart(models.Model):
         verbose_name = "Список покупок"
         verbose_name_plural = "Списки покупок"
         ordering = ["recipe"]
+        constraints = (
+            models.UniqueConstraint(fields=("user", "recipe"),
+                                    name="unique_cart"),
+        )
 
     def __str__(self):
         return f"{self.user} добавил в список покупок {self.recipe}"
+
+
+class RecipeRanking(models.Model):
+    """ Готовые рейтинги рецептов для ?ordering=popular|trending.
+
+        Таблицу целиком пересчитывает python manage.py compute_rankings,
+        запросы списка только читают позицию рецепта.
+    """
+
+    POPULAR = 'popular'
+    TRENDING = 'trending'
+    KINDS = (
+        (POPULAR, 'Популярные'),
+        (TRENDING, 'Набирают популярность'),
+    )
+
+    kind = models.CharField(
+        verbose_name='Рейтинг',
+        max_length=16,
+        choices=KINDS)
+    recipe = models.ForeignKey(
+        Recipe,
+        verbose_name='Рецепт',
+        related_name='rankings',
+        on_delete=models.CASCADE)
+    position = models.PositiveIntegerField(
+        verbose_name='Место')
+    score = models.PositiveIntegerField(
+        verbose_name='Очки')
+    computed_at = models.DateTimeField(
+        verbose_name='Дата и время расчета')
+
+    class Meta:
+        verbose_name = 'Рейтинг рецепта'
+        verbose_name_plural = 'Рейтинги рецептов'
+        ordering = ['kind', 'position']
+        constraints = (
+            models.UniqueConstraint(fields=('kind', 'recipe'),
+                                    name='unique_recipe_ranking'),
+        )
+        indexes = (
+            models.Index(fields=('kind', 'position'),
+                         name='recipe_ranking_position_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.kind} #{self.position}: {self.recipe}'
@@ -0,0 +1,138 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Lock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connections
+from django.utils import timezone
+from PIL import Image
+
+from api.cache import RECIPES_NAMESPACE, bump_stamp
+from api.core import IMAGE_VARIANTS, MAX_SIZE_IMAGE
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = "recipe_img/variants"
+
+executor = None
+executor_lock = Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_PROCESSING_WORKERS,
+                thread_name_prefix="recipe-image",
+            )
+    return executor
+
+
+def file_hash(path):
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_variant(image, name, image_format):
+    """ Файлы с хэшем в имени не меняются, их можно кэшировать навсегда """
+    if default_storage.exists(name):
+        return name
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def make_variants(image, image_hash):
+    """ Уменьшенные копии картинки в исходном формате и в WebP """
+    if image.mode not in ("RGB", "L", "RGBA", "LA", "P"):
+        image = image.convert("RGB")
+    if image.mode in ("RGB", "L"):
+        image_format, extension = "JPEG", "jpg"
+    else:
+        image_format, extension = "PNG", "png"
+    prefix = f"{VARIANTS_DIR}/{image_hash[:16]}"
+
+    variants = {}
+    for variant, size in IMAGE_VARIANTS.items():
+        copy = image.copy()
+        copy.thumbnail(size)
+        variants[variant] = save_variant(
+            copy, f"{prefix}_{variant}.{extension}", image_format
+        )
+        variants[f"{variant}_webp"] = save_variant(
+            copy, f"{prefix}_{variant}.webp", "WEBP"
+        )
+    return variants
+
+
+def process_recipe_image(recipe_id):
+    """ Уменьшает картинку рецепта до MAX_SIZE_IMAGE.
+
+        Заодно готовит уменьшенные копии из IMAGE_VARIANTS.
+        Задачу забирает тот, кто первым переведет рецепт из pending
+        в processing, поэтому поток и команда process_images не
+        обработают одну картинку дважды. Время захвата пишется в
+        image_claimed_at, по нему process_images находит задачи
+        умерших воркеров.
+    """
+    from recipes.models import Recipe
+
+    claimed = Recipe.objects.filter(
+        pk=recipe_id, image_status=Recipe.IMAGE_PENDING
+    ).update(image_status=Recipe.IMAGE_PROCESSING,
+             image_claimed_at=timezone.now())
+    if not claimed:
+        return False
+
+    recipe = Recipe.objects.only("image").get(pk=recipe_id)
+    name = recipe.image.name
+    try:
+        with Image.open(recipe.image.path) as image:
+            image.thumbnail(MAX_SIZE_IMAGE)
+            image.save(recipe.image.path)
+        image_hash = file_hash(recipe.image.path)
+        with Image.open(recipe.image.path) as image:
+            variants = make_variants(image, image_hash)
+        status = Recipe.IMAGE_DONE
+    except Exception:
+        logger.exception("Не удалось обработать картинку рецепта %s",
+                         recipe_id)
+        status, image_hash, variants = Recipe.IMAGE_FAILED, "", {}
+
+    # Если картинку успели заменить, статус уже снова pending.
+    Recipe.objects.filter(
+        pk=recipe_id, image=name, image_status=Recipe.IMAGE_PROCESSING
+    ).update(image_status=status, image_hash=image_hash,
+             image_variants=variants)
+    # В списках рецептов есть ссылки на уменьшенные копии
+    bump_stamp(RECIPES_NAMESPACE)
+    return status == Recipe.IMAGE_DONE
+
+
+def run_in_background(recipe_id):
+    close_old_connections()
+    try:
+        process_recipe_image(recipe_id)
+    finally:
+        connections.close_all()
+
+
+def enqueue_image_processing(recipe_id):
+    """ Ставит картинку в очередь.
+
+        IMAGE_PROCESSING_BROKER = "thread": пул потоков этого процесса.
+        Задачи, которые не успели выполниться до перезапуска процесса,
+        подберет только python manage.py process_images.
+        IMAGE_PROCESSING_BROKER = "database": очередью служат рецепты
+        в статусе pending, их разбирает python manage.py process_images.
+    """
+    if settings.IMAGE_PROCESSING_BROKER == "thread":
+        get_executor().submit(run_in_background, recipe_id)
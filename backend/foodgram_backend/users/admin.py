@@ -13,4 +13,6 @@ class SubscribeAdmin(admin.ModelAdmin):
 
 @admin.register(CustomUser)
 class CustomUserAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('username', 'email', 'recipes_count',
+                    'subscribers_count')
+    readonly_fields = ('recipes_count', 'subscribers_count')
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0003_alter_customuser_options_alter_subscribe_options'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['last_name', 'first_name', 'id'], name='user_name_idx'),
+        ),
+    ]
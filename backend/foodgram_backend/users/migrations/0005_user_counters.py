@@ -0,0 +1,40 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    User = apps.get_model('users', 'CustomUser')
+    for field, app_label, model_name, lookup in (
+        ('recipes_count', 'recipes', 'Recipe', 'author'),
+        ('subscribers_count', 'users', 'Subscribe', 'author'),
+    ):
+        model = apps.get_model(app_label, model_name)
+        total = (model.objects.filter(**{lookup: OuterRef('pk')})
+                 .order_by().values(lookup)
+                 .annotate(total=Count('id')).values('total'))
+        User.objects.update(**{field: Coalesce(Subquery(total), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_user_name_idx'),
+        ('recipes', '0012_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from api.core import exclude_counter_fields
+
 
 class CustomUser(AbstractUser):
     """Кастомный юзер"""
@@ -28,14 +30,63 @@ class CustomUser(AbstractUser):
         verbose_name="Активирован",
         default=True
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name="Рецептов",
+        default=0,
+        editable=False,
+    )
+    subscribers_count = models.PositiveIntegerField(
+        verbose_name="Подписчиков",
+        default=0,
+        editable=False,
+    )
+
+    COUNTER_FIELDS = ("recipes_count", "subscribers_count")
+    # От этих полей зависят кэши API, см. api/signals.py
+    TRACKED_FIELDS = ("email", "username", "first_name", "last_name",
+                      "password", "is_active")
 
     def __str__(self) -> str:
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_values = {
+            name: value for name, value in zip(field_names, values)
+            if name in cls.TRACKED_FIELDS
+        }
+        return instance
+
+    def changed_fields(self, names, update_fields=None):
+        """ Какие из names отличаются от прочитанных из базы.
+            Непрочитанное поле считается измененным.
+        """
+        loaded = getattr(self, "loaded_values", {})
+        if update_fields is not None:
+            names = set(names) & set(update_fields)
+        return {name for name in names
+                if name not in loaded or loaded[name] != getattr(self, name)}
+
+    def save(self, *args, **kwargs):
+        kwargs["update_fields"] = exclude_counter_fields(
+            self, self.COUNTER_FIELDS, kwargs.get("update_fields"))
+        super().save(*args, **kwargs)
+        saved = kwargs["update_fields"]
+        self.loaded_values = {
+            **getattr(self, "loaded_values", {}),
+            **{name: getattr(self, name) for name in self.TRACKED_FIELDS
+               if saved is None or name in saved},
+        }
+
     class Meta:
         verbose_name = "Пользователь"
         verbose_name_plural = "Пользователи"
         ordering = ["last_name", "first_name"]
+        indexes = (
+            models.Index(fields=("last_name", "first_name", "id"),
+                         name="user_name_idx"),
+        )
 
 
 class Subscribe(models.Model):